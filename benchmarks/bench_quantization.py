@@ -0,0 +1,179 @@
+# Recall and latency of the quantized candidate searches against the exact search
+#
+# Usage:
+#   python benchmarks/bench_quantization.py --rows 20000 --queries 200 --k 8 --output quantization.json
+#
+# The embeddings are computed locally like fake_openai.py does, sentences sharing words are close.
+# With --database-url (or BENCH_POSTGRES_URL) the half-precision and binary HNSW indexes of
+# PgVectorStore are measured too, the benchmark then writes to pdf_holder of that database.
+import argparse, json, os, random, sys, tempfile, time
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from streamlit_app import LocalVectorStore, PgVectorStore  # noqa: E402
+from fake_openai import embed  # noqa: E402
+from pdf_factory import make_sentences  # noqa: E402
+
+
+def make_corpus(rows, queries, seed=0):
+    """
+    Generates chunks with their embeddings, and questions made of words of random chunks.
+
+    Args:
+        rows (int): The number of chunks.
+        queries (int): The number of questions.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        tuple: The list of {"text", "vector"} chunks and the list of question embeddings.
+    """
+    rng = random.Random(seed)
+    texts = [" ".join(make_sentences(rng, 3)) for _ in range(rows)]
+    embeddings = [{"text": chunk, "vector": embed(chunk)} for chunk in texts]
+    questions = [
+        embed(" ".join(rng.sample(chunk.split(), 6))) for chunk in rng.sample(texts, queries)
+    ]
+    return embeddings, questions
+
+
+def measure(label, search, exact_ids, questions, k):
+    """
+    Runs the questions through a search and compares its results with the exact ones.
+
+    Args:
+        label (str): The name of the configuration.
+        search (callable): Searches a question embedding, returns SearchResult rows.
+        exact_ids (list): The sets of chunk ids returned by the exact search, per question.
+        questions (list): The question embeddings.
+        k (int): The number of chunks returned per question.
+
+    Returns:
+        dict: The recall@k and the latency percentiles of the configuration.
+    """
+    latencies, hits = [], 0
+    for question, expected in zip(questions, exact_ids):
+        start = time.perf_counter()
+        results = search(question)
+        latencies.append(time.perf_counter() - start)
+        hits += len(expected & {result.id for result in results})
+    result = {
+        "configuration": label,
+        "recall_at_k": round(hits / (k * len(questions)), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 3),
+    }
+    print(
+        f"{label:<24} recall@{k} {result['recall_at_k']:.4f}"
+        f"  p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms"
+    )
+    return result
+
+
+def bench_local(embeddings, questions, k, document_hash="benchmark"):
+    """
+    Measures the local store without quantization and with binary candidates.
+    """
+    directory = tempfile.mkdtemp(prefix="bench-quantization-")
+    exact_store = LocalVectorStore(directory)
+    exact_store.store_document(embeddings, document_hash)
+    exact_ids = [
+        {result.id for result in exact_store.search(question, document_hash, k=k)}
+        for question in questions
+    ]
+    results = [
+        measure(
+            "local exact",
+            lambda q: exact_store.search(q, document_hash, k=k),
+            exact_ids,
+            questions,
+            k,
+        )
+    ]
+    for quantization in ("binary",):
+        store = LocalVectorStore(directory, quantization)
+        # Build the quantized copy of the document stored without it, as for existing documents
+        store.migrate()
+        results.append(
+            measure(
+                f"local {quantization}",
+                lambda q: store.search(q, document_hash, k=k),
+                exact_ids,
+                questions,
+                k,
+            )
+        )
+    sizes = {
+        extension: os.path.getsize(os.path.join(directory, f"{document_hash}.{extension}"))
+        for extension in ("npy", "binary.npy")
+    }
+    print("file sizes (bytes):", sizes)
+    return results, sizes
+
+
+def bench_pgvector(database_url, embeddings, questions, k, document_hash="benchmark"):
+    """
+    Measures the exact scan and the half-precision and binary HNSW indexes of the pgvector store.
+    """
+    engine = create_engine(database_url, client_encoding="utf8")
+    store = PgVectorStore(engine)
+    with engine.connect() as conn:
+        conn.execute(text("DELETE FROM pdf_documents WHERE document_hash = :h"), {"h": document_hash})
+        conn.execute(text("DELETE FROM pdf_holder WHERE document_hash = :h"), {"h": document_hash})
+        conn.commit()
+    store.store_document(embeddings, document_hash)
+    exact_ids = [
+        {result.id for result in store.search(q, document_hash, k=k, use_index=False)}
+        for q in questions
+    ]
+    results = [
+        measure(
+            "pgvector exact",
+            lambda q: store.search(q, document_hash, k=k, use_index=False),
+            exact_ids,
+            questions,
+            k,
+        )
+    ]
+    for quantization in ("halfvec", "binary"):
+        quantized_store = PgVectorStore(engine, quantization)
+        results.append(
+            measure(
+                f"pgvector {quantization}",
+                lambda q: quantized_store.search(q, document_hash, k=k),
+                exact_ids,
+                questions,
+                k,
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark quantized candidate searches.")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--database-url", default=os.getenv("BENCH_POSTGRES_URL"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="quantization_results.json")
+    args = parser.parse_args()
+
+    embeddings, questions = make_corpus(args.rows, args.queries, args.seed)
+    results, sizes = bench_local(embeddings, questions, args.k)
+    if args.database_url:
+        results += bench_pgvector(args.database_url, embeddings, questions, args.k)
+
+    report = {
+        "config": vars(args) | {"database_url": bool(args.database_url)},
+        "local_file_sizes": sizes,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Memory and CPU cost of the embedding representations, from the API response to pgvector
+#
+# Usage:
+#   python benchmarks/bench_serialization.py --chunks 2000 --repeat 5 --output serialization.json
+#
+# Compares, without any network or database, the Python lists of floats and the text formats
+# the embeddings used to travel in with the float32 matrices, base64 responses and binary
+# pgvector formats used now.
+import argparse, base64, csv, io, json, os, statistics, sys, time, tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from streamlit_app import (  # noqa: E402
+    PgVectorStore,
+    format_vector,
+    vector_from_binary,
+)
+
+DIMENSIONS = 3072
+
+
+def timed(func, repeat):
+    """
+    Runs a function `repeat` times and returns its median duration in milliseconds and its result.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return round(statistics.median(durations) * 1000, 3), result
+
+
+def peak_memory(func):
+    """
+    Runs a function and returns the peak memory it allocated in megabytes, and its result.
+    """
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 2**20, 2), result
+
+
+def make_responses(matrix):
+    """
+    Builds the bodies of an embeddings response with JSON floats and with base64 embeddings.
+    """
+    float_body = json.dumps(
+        {"data": [{"index": i, "embedding": row.tolist()} for i, row in enumerate(matrix)]}
+    )
+    base64_body = json.dumps(
+        {
+            "data": [
+                {"index": i, "embedding": base64.b64encode(row.tobytes()).decode("ascii")}
+                for i, row in enumerate(matrix)
+            ]
+        }
+    )
+    return float_body, base64_body
+
+
+def decode_floats(body):
+    # As before: one list of Python floats per chunk
+    return [item["embedding"] for item in json.loads(body)["data"]]
+
+
+def decode_base64(body):
+    data = json.loads(body)["data"]
+    packed = b"".join(base64.b64decode(item["embedding"]) for item in data)
+    return np.frombuffer(packed, dtype="<f4").reshape(len(data), -1).astype(np.float32)
+
+
+def copy_csv(vectors, texts):
+    # As before: COPY in CSV with each vector in the pgvector text format
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for chunk, vector in zip(texts, vectors):
+        writer.writerow(["benchmark", chunk, "[" + ",".join(map(str, vector)) + "]"])
+    return buffer.getvalue().encode("utf8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the embedding representations.")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="serialization_results.json")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    matrix = rng.standard_normal((args.chunks, DIMENSIONS), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    texts = [f"Chunk {i}, with a comma and a \"quote\"." for i in range(args.chunks)]
+    float_body, base64_body = make_responses(matrix)
+    # The serialization only, the store is not connected to any database
+    store = PgVectorStore.__new__(PgVectorStore)
+
+    results = {}
+    memory_lists, lists = peak_memory(lambda: decode_floats(float_body))
+    memory_matrix, decoded = peak_memory(lambda: decode_base64(base64_body))
+    assert np.array_equal(decoded, matrix)
+    results["response_bytes"] = {"floats": len(float_body), "base64": len(base64_body)}
+    results["decoded_peak_mb"] = {"lists": memory_lists, "float32_matrix": memory_matrix}
+    results["decode_ms"] = {
+        "floats": timed(lambda: decode_floats(float_body), args.repeat)[0],
+        "base64": timed(lambda: decode_base64(base64_body), args.repeat)[0],
+    }
+
+    csv_ms, csv_data = timed(lambda: copy_csv(lists, texts), args.repeat)
+    binary_ms, binary_data = timed(
+        lambda: store._rows_to_copy(
+            ("benchmark", chunk, vector) for chunk, vector in zip(texts, decoded)
+        ).getvalue(),
+        args.repeat,
+    )
+    results["copy_ms"] = {"csv_text": csv_ms, "binary": binary_ms}
+    results["copy_bytes"] = {"csv_text": len(csv_data), "binary": len(binary_data)}
+
+    query_list, query = lists[0], decoded[0]
+    old_query_ms, old_literal = timed(
+        lambda: "[" + ",".join(map(str, query_list)) + "]", args.repeat * 20
+    )
+    new_query_ms, new_literal = timed(lambda: format_vector(query), args.repeat * 20)
+    results["query_parameter_ms"] = {"str_join": old_query_ms, "format_vector": new_query_ms}
+    results["query_parameter_bytes"] = {"str_join": len(old_literal), "format_vector": len(new_literal)}
+
+    sent = b"\x0c\x00\x00\x00" + query.astype(">f4").tobytes()
+    results["read_vector_ms"] = {
+        "text": timed(
+            lambda: np.fromstring(old_literal[1:-1], dtype=np.float32, sep=","), args.repeat * 20
+        )[0],
+        "binary": timed(lambda: vector_from_binary(sent), args.repeat * 20)[0],
+    }
+
+    for name, values in results.items():
+        print(f"{name:<24} " + "  ".join(f"{key} {value}" for key, value in values.items()))
+    with open(args.output, "w") as f:
+        json.dump({"config": vars(args), "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Cold start and rerun overhead of the app: import time, broken down by imported package
+#
+# Usage:
+#   python benchmarks/bench_startup.py --runs 5 --reruns 20 --output startup.json
+#
+# Each cold start imports streamlit_app in a new interpreter with -X importtime. A rerun executes
+# the script's module code again in the warm interpreter, as Streamlit does on every interaction
+# (without calling main, which depends on the session).
+import argparse, json, os, statistics, subprocess, sys, time
+from collections import defaultdict
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_PATH = os.path.join(APP_DIRECTORY, "streamlit_app.py")
+
+
+def parse_importtime(stderr, module="streamlit_app"):
+    """
+    Reads the -X importtime report of an import.
+
+    Args:
+        stderr (str): The standard error of the interpreter, with the importtime lines.
+        module (str): The module whose direct imports are broken down.
+
+    Returns:
+        tuple: The cumulative import time of the module in seconds, and the cumulative time of each of its direct imports.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative) / 1e6))
+    # A module's imports are listed before it, one level deeper
+    for index, (depth, name, total) in enumerate(rows):
+        if name == module:
+            break
+    else:
+        raise ValueError(f"{module} is not in the importtime report")
+    children = {}
+    for child_depth, child, cumulative in reversed(rows[:index]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 2:
+            children[child] = cumulative
+    return total, children
+
+
+def cold_start(runs):
+    """
+    Imports the app in new interpreters and returns the median total and per-package times.
+    """
+    totals, packages = [], defaultdict(list)
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import streamlit_app"],
+            cwd=APP_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        total, children = parse_importtime(process.stderr)
+        totals.append(total)
+        for name, cumulative in children.items():
+            packages[name].append(cumulative)
+    breakdown = {
+        name: round(statistics.median(times) * 1000, 1)
+        for name, times in sorted(packages.items(), key=lambda item: -statistics.median(item[1]))
+    }
+    return round(statistics.median(totals) * 1000, 1), breakdown
+
+
+def rerun(reruns):
+    """
+    Executes the app's module code repeatedly in this interpreter and returns the median time.
+    """
+    sys.path.insert(0, APP_DIRECTORY)
+    with open(APP_PATH) as f:
+        code = compile(f.read(), APP_PATH, "exec")
+    times = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        exec(code, {"__name__": "__rerun__", "__file__": APP_PATH})
+        times.append(time.perf_counter() - start)
+    return round(statistics.median(times) * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's cold start and reruns.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", default="startup_results.json")
+    args = parser.parse_args()
+
+    import_ms, breakdown = cold_start(args.runs)
+    print(f"cold import of streamlit_app: {import_ms} ms (median of {args.runs})")
+    for name, cumulative_ms in list(breakdown.items())[: args.top]:
+        print(f"  {name:<40} {cumulative_ms:>9.1f} ms")
+    rerun_ms = rerun(args.reruns)
+    print(f"rerun of the module code: {rerun_ms} ms (median of {args.reruns})")
+
+    report = {
+        "config": vars(args),
+        "python": sys.version.split()[0],
+        "cold_import_ms": import_ms,
+        "import_breakdown_ms": breakdown,
+        "rerun_ms": rerun_ms,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# Local stand-in for the OpenAI endpoints used by the app, with deterministic responses and configurable latency
+#
+# Usage:
+#   python benchmarks/fake_openai.py --port 8765 --latency 0.2
+#
+# then point the OpenAI client at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+import argparse, base64, collections, json, threading, time, zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DIMENSIONS = 3072
+
+
+@lru_cache(maxsize=100_000)
+def word_vector(word):
+    """
+    Returns the random but fixed vector of a word.
+    """
+    rng = np.random.default_rng(zlib.crc32(word.encode("utf8")))
+    return rng.standard_normal(DIMENSIONS).astype(np.float32)
+
+
+def embed(text, dimensions=DIMENSIONS):
+    """
+    Embeds a text as the normalized sum of its words' vectors, so texts sharing words are close.
+
+    Args:
+        text (str): The text to embed.
+        dimensions (int): The number of dimensions of the embedding.
+
+    Returns:
+        numpy.ndarray: The unit-normalized float32 embedding.
+    """
+    words = [word.strip(".,;:!?").lower() for word in text.split()] or [""]
+    vector = np.sum([word_vector(word) for word in words], axis=0)[:dimensions]
+    return vector / np.linalg.norm(vector)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Serves the embeddings, moderations and chat completions endpoints.
+    """
+
+    # Seconds waited before answering each request, and between streamed tokens
+    latency = 0.0
+    token_latency = 0.0
+    # Requests accepted per second, the others are answered 429 like the real API, None for no limit
+    rate_limit = None
+    recent_requests = collections.deque()
+    # Number of requests served per endpoint
+    counts = {}
+    counts_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_rate_limit_headers(self):
+        # Reported like the real API, so clients can pace themselves at the limit
+        if self.rate_limit is not None:
+            self.send_header("x-ratelimit-limit-requests", str(self.rate_limit * 60))
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self._send_rate_limit_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rate_limited(self):
+        # Sliding window of the requests accepted during the last second, called under counts_lock
+        now = time.monotonic()
+        while self.recent_requests and now - self.recent_requests[0] >= 1:
+            self.recent_requests.popleft()
+        if self.rate_limit is not None and len(self.recent_requests) >= self.rate_limit:
+            return 1 - (now - self.recent_requests[0])
+        self.recent_requests.append(now)
+        return None
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        endpoint = self.path.rstrip("/").split("/")[-1]
+        with self.counts_lock:
+            retry_after = self._rate_limited()
+            key = "rate_limited" if retry_after is not None else endpoint
+            self.counts[key] = self.counts.get(key, 0) + 1
+        if retry_after is not None:
+            error = {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+            body = json.dumps({"error": error}).encode("utf8")
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Retry-After", str(max(1, round(retry_after))))
+            self.send_header("Retry-After-Ms", str(int(retry_after * 1000)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        time.sleep(self.latency)
+        if endpoint == "embeddings":
+            self.embeddings(request)
+        elif endpoint == "moderations":
+            self.moderations(request)
+        elif endpoint == "completions":
+            self.chat_completions(request)
+        else:
+            self.send_error(404)
+
+    def embeddings(self, request):
+        inputs = request["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = []
+        for index, text in enumerate(inputs):
+            vector = embed(text, request.get("dimensions", DIMENSIONS))
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                vector = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        tokens = sum(len(text.split()) for text in inputs)
+        self._send_json(
+            {
+                "object": "list",
+                "data": data,
+                "model": request["model"],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    def moderations(self, request):
+        inputs = request["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self._send_json(
+            {
+                "id": "modr-fake",
+                "model": request.get("model", "text-moderation-latest"),
+                "results": [
+                    {"flagged": False, "categories": {}, "category_scores": {}}
+                    for _ in inputs
+                ],
+            }
+        )
+
+    def chat_completions(self, request):
+        # Answer with the first words of the prompt, enough to exercise the response path
+        prompt = request["messages"][-1]["content"]
+        tokens = [word + " " for word in prompt.split()[:60]]
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": request["model"]}
+        if not request.get("stream"):
+            self._send_json(
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": len(prompt.split()),
+                        "completion_tokens": len(tokens),
+                        "total_tokens": len(prompt.split()) + len(tokens),
+                    },
+                }
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self._send_rate_limit_headers()
+        self.end_headers()
+        for index, token in enumerate(tokens + [None]):
+            if index:
+                time.sleep(self.token_latency)
+            chunk = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": token} if token else {},
+                        "finish_reason": None if token else "stop",
+                    }
+                ],
+            }
+            self.wfile.write(b"data: " + json.dumps(chunk).encode("utf8") + b"\n\n")
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def start_server(port=0, latency=0.0, token_latency=0.0, rate_limit=None):
+    """
+    Starts the fake OpenAI server in a background thread.
+
+    Args:
+        port (int): The port to listen on, 0 picks a free one.
+        latency (float): Seconds waited before answering each request.
+        token_latency (float): Seconds waited between streamed tokens.
+        rate_limit (int): Requests accepted per second, the others are answered 429, None for no limit.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its base URL is http://127.0.0.1:<server_port>/v1
+    """
+    handler = type(
+        "ConfiguredFakeOpenAIHandler",
+        (FakeOpenAIHandler,),
+        {
+            "latency": latency,
+            "token_latency": token_latency,
+            "rate_limit": rate_limit,
+            "counts": {},
+            "recent_requests": collections.deque(),
+        },
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI API server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=None, help="requests per second")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency, args.token_latency, args.rate_limit)
+    print(f"Fake OpenAI API listening on http://127.0.0.1:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
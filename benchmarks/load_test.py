@@ -0,0 +1,278 @@
+# Load test of the app's pipeline with concurrent sessions, ramping up the concurrency
+#
+# Usage:
+#   python benchmarks/load_test.py --concurrency 1 2 4 8 16 --rounds 3 --pages 20 --questions 3 \
+#       --latency 0.3 --token-latency 0.02 --drive-latency 0.5 --rate-limit 50 --output load.json
+#
+# Each simulated session runs what main() runs for a user: the upload, process_pre_run,
+# upload_to_google_drive, then per question the answer cache, process_user_question and
+# process_streamed_response. OpenAI is replaced by the local server of fake_openai.py and the
+# Google Drive upload by a sleep of --drive-latency seconds per chunk of the resumable upload.
+#
+# The functions run in bare mode, outside `streamlit run`, where every session shares the same
+# session_state. Each session uploads a different PDF so every upload is really ingested. The
+# Streamlit secrets of the run are written to a temporary .streamlit/secrets.toml. Without
+# --database-url the local vector store is used.
+import argparse, io, json, math, os, platform, random, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from fake_openai import start_server  # noqa: E402
+from pdf_factory import WORDS, make_pdf  # noqa: E402
+
+
+def write_secrets(args, directory):
+    """
+    Writes the Streamlit secrets of the load test, Streamlit reads them from the working directory.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+        directory (str): The working directory of the load test.
+    """
+    secrets = {
+        "OPENAI_API_KEY": "fake",
+        "QUESTION_WORKERS": args.question_workers,
+        "DB_POOL_SIZE": args.db_pool_size,
+        "DB_MAX_OVERFLOW": args.db_max_overflow,
+    }
+    if args.database_url:
+        secrets["SUPABASE_POSTGRES_URL"] = args.database_url
+    else:
+        secrets["VECTOR_STORE"] = "local"
+        secrets["LOCAL_VECTOR_STORE_PATH"] = os.path.join(directory, "vector_store")
+    os.makedirs(os.path.join(directory, ".streamlit"), exist_ok=True)
+    with open(os.path.join(directory, ".streamlit", "secrets.toml"), "w") as f:
+        for key, value in secrets.items():
+            f.write(f"{key} = {json.dumps(value)}\n")
+
+
+def install_fake_drive(app, latency):
+    """
+    Replaces the Google Drive calls of the shared DriveUploader by a sleep per uploaded chunk.
+
+    The uploader keeps its single background worker and its deduplication, so the upload queue
+    builds up under load as it does in the app.
+
+    Returns:
+        list: The seconds from submission to completion of each upload, filled as they complete.
+    """
+    completion_times = []
+
+    class FakeDriveUploader(app.DriveUploader):
+        def submit(self, name, data, document_hash):
+            submitted = time.perf_counter()
+            upload = super().submit(name, data, document_hash)
+            upload.add_done_callback(
+                lambda _: completion_times.append(time.perf_counter() - submitted)
+            )
+            return upload
+
+        def _upload(self, name, data, document_hash):
+            time.sleep(latency * math.ceil(len(data) / self.chunk_size))
+            return f"https://drive.google.com/file/d/{document_hash[:12]}/preview"
+
+    uploader = FakeDriveUploader()
+    app.get_drive_uploader = lambda: uploader
+    return completion_times
+
+
+class UploadedPDF(io.BytesIO):
+    """
+    Stands for Streamlit's UploadedFile, a file-like object with a name.
+    """
+
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def run_session(app, pdf_bytes, name, questions):
+    """
+    Runs the pipeline of main() for one user, an upload followed by questions.
+
+    Args:
+        app (module): The imported streamlit_app module.
+        pdf_bytes (bytes): The content of the uploaded PDF.
+        name (str): The name of the uploaded PDF.
+        questions (list): The questions asked about the PDF.
+
+    Returns:
+        dict: The latencies of the session, of its pre-run and of its questions, and its outcomes.
+    """
+    result = {"pre_run_s": None, "question_s": [], "errors": 0, "not_related": 0}
+    start = time.perf_counter()
+    try:
+        uploaded_file = UploadedPDF(pdf_bytes, name)
+        document_hash = app.process_pre_run(uploaded_file)
+        result["pre_run_s"] = time.perf_counter() - start
+        if document_hash is None:
+            result["errors"] += 1
+            return result
+        app.upload_to_google_drive(uploaded_file, document_hash)
+
+        service_class = app.IntentService()
+        answer_cache = app.get_answer_cache()
+        for question in questions:
+            question_start = time.perf_counter()
+            if answer_cache.lookup(document_hash, question) is None:
+                retrieved_info, question, vectorized_question, cached_response = (
+                    app.process_user_question(service_class, question, document_hash)
+                )
+                if retrieved_info is None:
+                    # Either a similar question was already answered, or it is not related
+                    result["not_related"] += cached_response is None
+                else:
+                    response = app.process_streamed_response(retrieved_info, question)
+                    if response:
+                        answer_cache.store(document_hash, question, vectorized_question, response)
+                    else:
+                        result["errors"] += 1
+            result["question_s"].append(time.perf_counter() - question_start)
+    except Exception as e:
+        print(f"session error: {e}", file=sys.stderr)
+        result["errors"] += 1
+    finally:
+        result["session_s"] = time.perf_counter() - start
+    return result
+
+
+def percentiles(values):
+    """
+    Returns the p50, p95 and p99 of a list of seconds, in milliseconds.
+    """
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        f"p{q}_ms": round(float(np.percentile(values, q)) * 1000, 1) for q in (50, 95, 99)
+    }
+
+
+def run_level(app, concurrency, args, drive_times):
+    """
+    Runs `rounds` sessions per simulated user with `concurrency` users at a time.
+
+    Returns:
+        dict: The throughput, the tail latencies and the error rate of the level.
+    """
+    rng = random.Random(args.seed + concurrency)
+    sessions = concurrency * args.rounds
+    # A different PDF per session, and per level, so none of them is already in the vector store
+    pdfs = [
+        make_pdf(args.pages, seed=args.seed + 1_000_000 * concurrency + session)
+        for session in range(sessions)
+    ]
+    questions = [
+        [" ".join(rng.sample(WORDS, 8)) + "?" for _ in range(args.questions)]
+        for _ in range(sessions)
+    ]
+    drive_start = len(drive_times)
+    # The session shortcut of process_pre_run would skip the ingestion of another session's PDF
+    app.st.session_state.pop("ingested_document_hash", None)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda i: run_session(app, pdfs[i], f"load-{concurrency}-{i}.pdf", questions[i]),
+                range(sessions),
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    question_latencies = [s for result in results for s in result["question_s"]]
+    errors = sum(result["errors"] for result in results)
+    level = {
+        "concurrency": concurrency,
+        "sessions": sessions,
+        "elapsed_s": round(elapsed, 2),
+        "sessions_per_s": round(sessions / elapsed, 3),
+        "questions_per_s": round(len(question_latencies) / elapsed, 3),
+        "error_rate": round(errors / (sessions * (1 + args.questions)), 4),
+        "not_related": sum(result["not_related"] for result in results),
+        "session": percentiles([result["session_s"] for result in results]),
+        "pre_run": percentiles(
+            [result["pre_run_s"] for result in results if result["pre_run_s"] is not None]
+        ),
+        "question": percentiles(question_latencies),
+        "drive_upload": percentiles(drive_times[drive_start:]),
+    }
+    print(
+        f"{concurrency:>4} users  {level['sessions_per_s']:>7} sessions/s"
+        f"  {level['questions_per_s']:>7} questions/s"
+        f"  pre-run p95 {level['pre_run']['p95_ms']} ms"
+        f"  question p95 {level['question']['p95_ms']} ms"
+        f"  errors {level['error_rate']:.2%}"
+    )
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent sessions load test.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--rounds", type=int, default=3, help="sessions per simulated user")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=3, help="questions per session")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_POSTGRES_URL"))
+    parser.add_argument("--latency", type=float, default=0.3, help="fake OpenAI latency in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--rate-limit", type=int, default=None, help="OpenAI requests per second")
+    parser.add_argument("--drive-latency", type=float, default=0.5, help="seconds per upload chunk")
+    parser.add_argument("--question-workers", type=int, default=8)
+    parser.add_argument("--db-pool-size", type=int, default=5)
+    parser.add_argument("--db-max-overflow", type=int, default=10)
+    parser.add_argument("--slo", type=float, default=10.0, help="p95 question latency target in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="load_test_results.json")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    server = start_server(
+        latency=args.latency, token_latency=args.token_latency, rate_limit=args.rate_limit
+    )
+    openai.base_url = f"http://127.0.0.1:{server.server_port}/v1/"
+    openai.api_key = "fake"
+    # Streamlit reads the secrets from the working directory, the app is imported from there
+    directory = tempfile.mkdtemp(prefix="load-test-")
+    write_secrets(args, directory)
+    os.chdir(directory)
+    import streamlit_app as app
+
+    drive_times = install_fake_drive(app, args.drive_latency)
+    levels = [run_level(app, concurrency, args, drive_times) for concurrency in args.concurrency]
+    server.shutdown()
+
+    # The capacity is the highest concurrency meeting the latency target without errors
+    within_slo = [
+        level["concurrency"]
+        for level in levels
+        if level["error_rate"] == 0
+        and level["question"]["p95_ms"] is not None
+        and level["question"]["p95_ms"] <= args.slo * 1000
+    ]
+    capacity = max(within_slo, default=None)
+    print(f"capacity: {capacity} concurrent users within a p95 question latency of {args.slo} s")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "vector_store": type(app.get_vector_store()).__name__,
+        },
+        "config": vars(args) | {"database_url": bool(args.database_url)},
+        "capacity": capacity,
+        "openai_requests": server.RequestHandlerClass.counts,
+        "stages": app.get_metrics().snapshot(),
+        "levels": levels,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
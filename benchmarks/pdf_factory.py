@@ -0,0 +1,85 @@
+# Generates text PDFs of any number of pages for the benchmarks, without any PDF library
+import random
+
+# Small vocabulary so that questions share words with the chunks they are about
+WORDS = (
+    "pump valve pressure sensor manual clause contract warranty engine filter "
+    "battery voltage module firmware update install remove replace inspect "
+    "torque bolt panel cable connector switch relay fuse circuit ground "
+    "temperature limit warning caution service interval schedule report "
+    "customer supplier payment invoice term notice party agreement liability "
+    "section appendix figure table chapter overview summary result method data"
+).split()
+
+
+def make_sentences(rng, count):
+    """
+    Generates pseudo-English sentences from the benchmark vocabulary.
+
+    Args:
+        rng (random.Random): The random generator.
+        count (int): The number of sentences.
+
+    Returns:
+        list: The sentences.
+    """
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + "."
+        for _ in range(count)
+    ]
+
+
+def make_pdf(pages, lines_per_page=45, seed=0):
+    """
+    Builds a PDF with one line of text per sentence, using the standard Helvetica font.
+
+    Args:
+        pages (int): The number of pages.
+        lines_per_page (int): The number of lines of text on each page.
+        seed (int): The seed of the random generator, the same seed gives the same PDF.
+
+    Returns:
+        bytes: The content of the PDF.
+    """
+    rng = random.Random(seed)
+    # Objects 1 to 3 are the catalog, the page tree and the font, then one page and one content stream per page
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    page_ids = []
+    for page in range(pages):
+        page_id = 4 + 2 * page
+        lines = [f"Page {page + 1}."] + make_sentences(rng, lines_per_page - 1)
+        stream = (
+            "BT /F1 10 Tf 50 780 Td 14 TL "
+            + " ".join(f"({line}) '" for line in lines)
+            + " ET"
+        ).encode("latin-1")
+        objects[page_id] = (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (page_id + 1)
+        )
+        objects[page_id + 1] = (
+            b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream"
+        )
+        page_ids.append(page_id)
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids),
+        pages,
+    )
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for object_id in range(1, len(objects) + 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % object_id + objects[object_id] + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        pdf += b"%010d 00000 n \n" % offset
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref_offset,
+    )
+    return bytes(pdf)
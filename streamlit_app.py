@@ -1,39 +1,1889 @@
 # Import necessary libraries
 import streamlit as st
 import numpy as np
-import openai, os, requests, tempfile
+import os, re, hashlib, sqlite3, time, io, threading, json, logging, random, base64, struct
+import multiprocessing
+import tiktoken
+
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+# openai, pdfminer, requests, streamlit_lottie and the Google Drive clients take most of the
+# import time, they are imported where they are first used so the app starts without them
+
+
+# Lottie animation displayed while a PDF is processed, and its copy on disk
+LOADING_ANIMATION_URL = "https://lottie.host/5ac92c74-1a02-40ff-ac96-947c14236db1/u4nCMW6fXU.json"
+LOADING_ANIMATION_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "assets", "loading_animation.json"
+)
+
+
+# Function to load Lottie animations using URL
+@st.cache_data
+def load_lottieurl(url, cache_path=None, timeout: float = 3):
+    """
+    Fetches and caches a Lottie animation from a provided URL.
+
+    The animation is read from `cache_path` when that file exists, and saved there after it is
+    fetched, so it is only downloaded once and the app does not depend on the network to start.
+
+    Args:
+    url (str): The URL of the Lottie animation.
+    cache_path (str): The file the animation is read from and saved to, None to always fetch it.
+    timeout (float): The number of seconds to wait for the animation.
+
+    Returns:
+    dict: The Lottie animation JSON or None if the request fails.
+    """
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            return json.load(f)
+    import requests
+
+    try:
+        r = requests.get(url, timeout=timeout)  # Perform the GET request
+        if r.status_code != 200:
+            return None  # Return None if request failed
+        animation = r.json()  # The JSON content of the Lottie animation
+    except (requests.RequestException, ValueError):
+        return None
+    if cache_path:
+        try:
+            # Write then rename, so a concurrent reader never sees a partial file
+            with open(f"{cache_path}.tmp", "w") as f:
+                json.dump(animation, f)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except OSError:
+            pass  # A read-only deployment fetches the animation once per process instead
+    return animation
+
+
+##### Metrics #####
+
+
+class MetricsRecorder:
+    """
+    Records the duration of the pipeline stages and counters such as tokens and chunks,
+    and forwards every measurement to the configured sinks.
+    """
+
+    def __init__(self, sinks=None):
+        """
+        Initializes an empty recorder.
+
+        Args:
+            sinks (list): Callables called with (kind, name, value) for each measurement, where kind is "span" or "counter".
+        """
+        self.sinks = sinks or []
+        # stage -> [number of spans, total seconds, last seconds]
+        self.spans = defaultdict(lambda: [0, 0.0, 0.0])
+        self.counters = defaultdict(float)
+        # The recorder is shared by every Streamlit session and worker thread of the process
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str):
+        """
+        Times the enclosed block as one span of a stage, even when it raises.
+
+        Args:
+            stage (str): The name of the stage, such as "intent.moderation".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float):
+        """
+        Records a duration measured elsewhere for a stage.
+
+        Args:
+            stage (str): The name of the stage.
+            seconds (float): The duration of the stage.
+        """
+        with self.lock:
+            totals = self.spans[stage]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = seconds
+        for sink in self.sinks:
+            sink("span", stage, seconds)
+
+    def count(self, name: str, value: float = 1):
+        """
+        Increments a counter, such as a number of tokens or chunks.
+
+        Args:
+            name (str): The name of the counter.
+            value (float): The increment.
+        """
+        with self.lock:
+            self.counters[name] += value
+        for sink in self.sinks:
+            sink("counter", name, value)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the spans, as count, total and last seconds per stage, and the counters.
+        """
+        with self.lock:
+            return {
+                "spans": {
+                    stage: {"count": count, "total_s": total, "last_s": last}
+                    for stage, (count, total, last) in self.spans.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Formats the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            "# TYPE talk_to_pdf_stage_seconds summary",
+        ]
+        for stage, span in snapshot["spans"].items():
+            lines.append(f'talk_to_pdf_stage_seconds_count{{stage="{stage}"}} {span["count"]}')
+            lines.append(f'talk_to_pdf_stage_seconds_sum{{stage="{stage}"}} {span["total_s"]}')
+        lines.append("# TYPE talk_to_pdf_total counter")
+        for name, value in snapshot["counters"].items():
+            lines.append(f'talk_to_pdf_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# Metrics sink writing one log line per measurement
+def log_metrics_sink(kind, name, value):
+    if kind == "span":
+        logging.getLogger("talk_to_pdf.metrics").info("%s took %.1f ms", name, value * 1000)
+    else:
+        logging.getLogger("talk_to_pdf.metrics").info("%s +%g", name, value)
+
+
+# Serves the metrics in the Prometheus text format from a background thread
+def start_metrics_server(metrics: MetricsRecorder, port: int) -> ThreadingHTTPServer:
+    """
+    Starts an HTTP server exposing the metrics on /metrics, for Prometheus to scrape.
+
+    Args:
+        metrics (MetricsRecorder): The recorder to expose.
+        port (int): The port to listen on.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Function to get the metrics recorder shared by all the services
+@st.cache_resource
+def get_metrics():
+    """
+    Creates and caches a single MetricsRecorder for the whole process.
+
+    Measurements are logged when the optional METRICS_LOG secret is set, and served in the
+    Prometheus format on the METRICS_PORT secret's port when it is set.
+
+    Returns:
+        MetricsRecorder: The process-wide metrics recorder.
+    """
+    try:
+        log_metrics = st.secrets.get("METRICS_LOG", False)
+        metrics_port = st.secrets.get("METRICS_PORT")
+    except FileNotFoundError:
+        # No secrets outside of the app (e.g. in the benchmarks), record without any sink
+        log_metrics, metrics_port = False, None
+    metrics = MetricsRecorder([log_metrics_sink] if log_metrics else [])
+    if metrics_port:
+        start_metrics_server(metrics, int(metrics_port))
+    return metrics
+
+
+# Displays the metrics in the sidebar of the app
+def render_metrics_panel():
+    """
+    Renders the per-stage timings and the counters in the sidebar, when the DEBUG_METRICS secret is set.
+    """
+    if not st.secrets.get("DEBUG_METRICS", False):
+        return
+    snapshot = get_metrics().snapshot()
+    with st.sidebar:
+        st.subheader("Metrics")
+        st.table(
+            {
+                stage: {
+                    "count": span["count"],
+                    "mean (ms)": round(1000 * span["total_s"] / span["count"], 1),
+                    "last (ms)": round(1000 * span["last_s"], 1),
+                }
+                for stage, span in sorted(snapshot["spans"].items())
+            }
+        )
+        st.json(snapshot["counters"] | {"answer_cache": get_answer_cache().stats()})
+
+
+##### OpenAI client #####
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling the OpenAI API while it is considered down.
+    """
+
+
+class TokenBucket:
+    """
+    Paces the use of a per-minute budget, such as requests or tokens per minute, at a steady rate.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 0.1):
+        """
+        Initializes a full bucket.
+
+        Args:
+            per_minute (float): The budget refilled every minute.
+            burst_seconds (float): The number of seconds of budget that can be used at once after an idle period.
+        """
+        self.lock = threading.Lock()
+        self.burst_seconds = burst_seconds
+        self.set_rate(per_minute)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def set_rate(self, per_minute: float):
+        """
+        Changes the budget per minute, e.g. to the limit reported by the API.
+        """
+        with self.lock:
+            self.per_minute = per_minute
+            self.rate = per_minute / 60
+            self.capacity = max(1.0, self.rate * self.burst_seconds)
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Reserves part of the budget, waiting until the bucket has refilled enough for it.
+
+        The reservation is taken immediately and may leave the bucket in debt, so callers are
+        served in order and a request larger than the bucket still goes through.
+
+        Args:
+            amount (float): The budget used by the request.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.level -= amount
+            wait = -self.level / self.rate if self.level < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def refund(self, amount: float):
+        """
+        Gives back the part of a reservation that was not used, or takes more when it is negative.
+        """
+        with self.lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class OpenAIGateway:
+    """
+    Sends every OpenAI request of the app through per-endpoint rate limits, retries, an adaptive
+    concurrency limit and a circuit breaker.
+    """
+
+    # Resource of the OpenAI client used by each endpoint
+    ENDPOINTS = {
+        "embeddings": lambda client: client.embeddings,
+        "moderations": lambda client: client.moderations,
+        "chat": lambda client: client.chat.completions,
+    }
+
+    def __init__(
+        self,
+        limits: dict = None,
+        max_concurrency: int = 16,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        """
+        Initializes the gateway.
+
+        Args:
+            limits (dict): Per endpoint, the requests_per_minute and tokens_per_minute to stay under. Endpoints without limits adopt the ones reported by the API.
+            max_concurrency (int): The maximum number of requests in flight.
+            max_retries (int): The number of times a throttled or failed request is retried.
+            base_delay (float): The maximum delay in seconds before the first retry, doubled on each retry.
+            max_delay (float): The maximum delay in seconds between two retries.
+            failure_threshold (int): The number of consecutive failed requests that open the circuit.
+            reset_timeout (float): The number of seconds the circuit stays open before a request is tried again.
+        """
+        import openai
+
+        # The gateway retries, the client's own retries would ignore the rate limits
+        openai.max_retries = 0
+        self.buckets = {}
+        for endpoint, endpoint_limits in (limits or {}).items():
+            for kind in ("requests", "tokens"):
+                if endpoint_limits.get(f"{kind}_per_minute"):
+                    self.buckets[endpoint, kind] = TokenBucket(
+                        float(endpoint_limits[f"{kind}_per_minute"])
+                    )
+        self.configured = set(self.buckets)
+        self.buckets_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Additive increase, multiplicative decrease of the number of requests in flight
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.slots = threading.Condition()
+        # Circuit breaker, closed while opened_at is None
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.circuit_lock = threading.Lock()
+
+    def call(self, endpoint: str, tokens: int = 0, **kwargs):
+        """
+        Creates an OpenAI resource, e.g. an embedding, within the rate limits of its endpoint.
+
+        Throttled requests (429), timeouts, connection errors and server errors are retried after a
+        jittered exponential backoff, or after the delay asked by the API's Retry-After header.
+
+        Args:
+            endpoint (str): "embeddings", "moderations" or "chat".
+            tokens (int): The estimated number of tokens of the request, corrected with its usage when returned.
+            **kwargs: The arguments of the resource's create method.
+
+        Returns:
+            The parsed response of the API, a stream when called with stream=True.
+
+        Raises:
+            CircuitOpenError: If the API failed repeatedly and is not called for now.
+            openai.OpenAIError: If the request failed after all the retries, or cannot succeed.
+        """
+        import openai
+
+        resource = self.ENDPOINTS[endpoint](openai)
+        metrics = get_metrics()
+        for attempt in range(self.max_retries + 1):
+            try:
+                trial = self._check_circuit()
+            except CircuitOpenError:
+                if attempt == 0:
+                    raise
+                # The circuit opened while this request was retried, its own failure is the cause
+                raise error
+            waited = self._acquire_budget(endpoint, tokens)
+            if waited:
+                metrics.observe(f"openai.{endpoint}.rate_limit_wait", waited)
+            self._acquire_slot()
+            throttled = False
+            try:
+                raw = resource.with_raw_response.create(**kwargs)
+            except openai.RateLimitError as e:
+                throttled, error = True, e
+                metrics.count("openai_throttled")
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                self._record_result(success=False)
+                error = e
+            except openai.APIStatusError:
+                # Any other error is the request's, the API itself is up
+                self._record_result(success=True)
+                raise
+            else:
+                self._record_result(success=True)
+                self._adopt_limits(endpoint, raw.headers)
+                response = raw.parse()
+                usage = getattr(response, "usage", None)
+                if tokens and usage is not None:
+                    self._refund(endpoint, tokens - usage.total_tokens)
+                return response
+            finally:
+                self._release_slot(throttled)
+                if trial:
+                    self._end_trial()
+
+            if attempt == self.max_retries:
+                raise error
+            metrics.count("openai_retries")
+            time.sleep(self._retry_delay(attempt, getattr(error, "response", None)))
+
+    def _retry_delay(self, attempt: int, response) -> float:
+        """
+        Returns the seconds to wait before a retry, at least the delay asked by the API if any.
+        """
+        # Full jitter, so the retries of concurrent requests do not arrive together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        headers = response.headers if response is not None else {}
+        try:
+            if "retry-after-ms" in headers:
+                return max(delay, float(headers["retry-after-ms"]) / 1000)
+            if "retry-after" in headers:
+                return max(delay, float(headers["retry-after"]))
+        except ValueError:
+            pass  # An HTTP date instead of seconds, the backoff applies
+        return delay
+
+    def _acquire_budget(self, endpoint: str, tokens: int) -> float:
+        """
+        Waits for the request and token budgets of an endpoint, returns the seconds waited.
+        """
+        waited = 0.0
+        request_bucket = self.buckets.get((endpoint, "requests"))
+        if request_bucket:
+            waited += request_bucket.acquire(1)
+        token_bucket = self.buckets.get((endpoint, "tokens"))
+        if token_bucket and tokens:
+            waited += token_bucket.acquire(tokens)
+        return waited
+
+    def _refund(self, endpoint: str, tokens: int):
+        """
+        Corrects the token budget of an endpoint once the actual usage of a request is known.
+        """
+        token_bucket = self.buckets.get((endpoint, "tokens"))
+        if token_bucket:
+            token_bucket.refund(tokens)
+
+    def _adopt_limits(self, endpoint: str, headers):
+        """
+        Paces an endpoint without configured limits at the limits reported in the response headers.
+        """
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            if not limit or (endpoint, kind) in self.configured:
+                continue
+            limit = float(limit)
+            with self.buckets_lock:
+                bucket = self.buckets.get((endpoint, kind))
+                if bucket is None:
+                    self.buckets[endpoint, kind] = TokenBucket(limit)
+                elif bucket.per_minute != limit:
+                    bucket.set_rate(limit)
+
+    def _acquire_slot(self):
+        """
+        Waits until fewer requests than the current concurrency limit are in flight.
+        """
+        with self.slots:
+            while self.in_flight >= int(self.concurrency_limit):
+                self.slots.wait()
+            self.in_flight += 1
+
+    def _release_slot(self, throttled: bool):
+        """
+        Frees a slot, halving the concurrency limit after a throttled request and raising it slowly otherwise.
+        """
+        with self.slots:
+            self.in_flight -= 1
+            if throttled:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            else:
+                self.concurrency_limit = min(
+                    self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit
+                )
+            self.slots.notify_all()
+
+    def _check_circuit(self):
+        """
+        Fails fast while the circuit is open, then lets a single trial request through.
+
+        Returns:
+            bool: Whether the request is the trial request of an open circuit.
+        """
+        with self.circuit_lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self.trial_in_flight:
+                get_metrics().count("openai_circuit_rejected")
+                raise CircuitOpenError(
+                    f"The OpenAI API is unavailable, retrying in {max(remaining, 0):.0f} s"
+                )
+            self.trial_in_flight = True
+            return True
+
+    def _end_trial(self):
+        """
+        Lets another trial request through once the trial ended without a result, e.g. throttled.
+        """
+        with self.circuit_lock:
+            self.trial_in_flight = False
+
+    def _record_result(self, success: bool):
+        """
+        Closes the circuit after a success, opens it after failure_threshold consecutive failures.
+        """
+        with self.circuit_lock:
+            if success:
+                self.failures, self.opened_at = 0, None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    get_metrics().count("openai_circuit_opened")
+                # A failed trial keeps the circuit open for another reset_timeout
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        Returns the current concurrency limit, circuit state and rate limits.
+        """
+        return {
+            "concurrency_limit": round(self.concurrency_limit, 2),
+            "in_flight": self.in_flight,
+            "circuit": "open" if self.opened_at is not None else "closed",
+            "limits_per_minute": {
+                f"{endpoint}.{kind}": bucket.per_minute
+                for (endpoint, kind), bucket in self.buckets.items()
+            },
+        }
+
+
+# Function to get the OpenAI gateway shared by all the sessions
+@st.cache_resource
+def get_openai_gateway():
+    """
+    Creates and caches a single OpenAIGateway for the whole process.
+
+    The optional [openai_rate_limits] secrets table sets the requests_per_minute and
+    tokens_per_minute of the "embeddings", "moderations" and "chat" endpoints, which otherwise
+    adopt the limits reported by the API. OPENAI_MAX_CONCURRENCY (default 16) and
+    OPENAI_MAX_RETRIES (default 5) tune the concurrency and the retries.
+
+    Returns:
+        OpenAIGateway: The process-wide OpenAI gateway.
+    """
+    try:
+        limits = {
+            endpoint: dict(endpoint_limits)
+            for endpoint, endpoint_limits in st.secrets.get("openai_rate_limits", {}).items()
+        }
+        max_concurrency = int(st.secrets.get("OPENAI_MAX_CONCURRENCY", 16))
+        max_retries = int(st.secrets.get("OPENAI_MAX_RETRIES", 5))
+    except FileNotFoundError:
+        # No secrets outside of the app (e.g. in the benchmarks), adopt the API's limits
+        limits, max_concurrency, max_retries = {}, 16, 5
+    return OpenAIGateway(limits, max_concurrency=max_concurrency, max_retries=max_retries)
+
+
+# Rough token count of texts for the rate limits, about four characters per token in English
+def estimate_tokens(texts) -> int:
+    """
+    Estimates the number of tokens of texts without tokenizing them.
+
+    Args:
+        texts (str or list): The text or texts.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    return sum(len(item) // 4 + 1 for item in texts)
+
+
+# OpenAI model embedding the chunks and the questions, the embedding cache is keyed by it
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 3072
+
+
+# Unpacks the embeddings of an embeddings response requested with encoding_format="base64"
+def embeddings_to_matrix(response) -> np.ndarray:
+    """
+    Packs the embeddings of an OpenAI embeddings response into a float32 matrix.
+
+    The API sends base64 embeddings as the raw little-endian float32 bytes, about a quarter of the
+    size of their JSON floats and decoded without parsing any number.
+
+    Args:
+    response (CreateEmbeddingResponse): The response of the embeddings request.
+
+    Returns:
+    numpy.ndarray: One row per input, in the order of the inputs.
+    """
+    # The API may return the embeddings in any order, sort them back by input index
+    data = sorted(response.data, key=lambda e: e.index)
+    if not data:
+        return np.empty((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    if isinstance(data[0].embedding, str):
+        packed = b"".join(base64.b64decode(e.embedding) for e in data)
+        return np.frombuffer(packed, dtype="<f4").reshape(len(data), -1).astype(np.float32)
+    return np.array([e.embedding for e in data], dtype=np.float32)
+
+
+# Function to load the tokenizer used to size embedding batches
+@st.cache_resource
+def load_tokenizer():
+    """
+    Loads and caches the tokenizer matching the OpenAI embedding model.
+
+    Returns:
+    tiktoken.Encoding: The cl100k_base encoding used by text-embedding-3-large.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+# PDF bytes shared by the text extraction worker processes, set once per worker
+_worker_pdf_bytes = None
+
+
+def _init_pdf_worker(pdf_bytes):
+    """
+    Stores the PDF content in a text extraction worker so page ranges can be sent without it.
+
+    Args:
+    pdf_bytes (bytes): The content of the PDF.
+    """
+    global _worker_pdf_bytes
+    _worker_pdf_bytes = pdf_bytes
+
+
+def _extract_page_range(page_range):
+    """
+    Extracts the text of a range of pages of the PDF held by the worker.
+
+    Args:
+    page_range (range): The zero-based numbers of the pages to extract.
+
+    Returns:
+    str: The text of the pages, each followed by a form feed like pdfminer does for whole documents.
+    """
+    from pdfminer.high_level import extract_text as pdf_extract_text
+
+    return pdf_extract_text(
+        io.BytesIO(_worker_pdf_bytes),
+        page_numbers=page_range,
+        maxpages=page_range.stop,
+    )
+
+
+# Function to extract the text of a PDF page range by page range
+def iter_pdf_text(pdf_bytes, pages_per_task: int = 10, max_processes: int = None):
+    """
+    Yields the text of a PDF in page order, extracting page ranges in parallel on a process pool.
+
+    Small documents that fit in a single page range are extracted in the current process.
+
+    Args:
+    pdf_bytes (bytes): The content of the PDF.
+    pages_per_task (int): The number of pages extracted by a worker at a time.
+    max_processes (int): The number of worker processes, defaults to the number of CPU cores.
+
+    Yields:
+    str: The text of each consecutive page range.
+    """
+    from pdfminer.high_level import extract_text as pdf_extract_text
+    from pdfminer.pdfpage import PDFPage
+
+    page_count = sum(1 for _ in PDFPage.get_pages(io.BytesIO(pdf_bytes)))
+    get_metrics().count("pdf_pages", page_count)
+    page_ranges = [
+        range(start, min(start + pages_per_task, page_count))
+        for start in range(0, page_count, pages_per_task)
+    ]
+    if len(page_ranges) <= 1:
+        yield pdf_extract_text(io.BytesIO(pdf_bytes))
+        return
+    # Forking this multi-threaded process could copy locks held by other threads into the workers,
+    # they are started from a single-threaded server process instead (spawned where unavailable)
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(
+        max_workers=max_processes,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_init_pdf_worker,
+        initargs=(pdf_bytes,),
+    ) as executor:
+        # map returns the page ranges in order as soon as each one and its predecessors are done
+        yield from executor.map(_extract_page_range, page_ranges)
+
+
+# Function to create the database engine shared by all the services
+@st.cache_resource
+def get_engine():
+    """
+    Creates and caches a single SQLAlchemy engine, and its connection pool, for the whole process.
+
+    The pool can be tuned with the optional DB_POOL_SIZE, DB_MAX_OVERFLOW and DB_POOL_RECYCLE
+    secrets, and SQL statements are only logged when the SQL_ECHO secret is set.
+
+    Returns:
+    sqlalchemy.engine.Engine: The engine connected to the Supabase PostgreSQL database.
+    """
+    return create_engine(
+        st.secrets["SUPABASE_POSTGRES_URL"],
+        echo=bool(st.secrets.get("SQL_ECHO", False)),
+        client_encoding="utf8",
+        pool_size=int(st.secrets.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(st.secrets.get("DB_MAX_OVERFLOW", 10)),
+        # Check connections before use and renew them before the server side closes them
+        pool_pre_ping=True,
+        pool_recycle=int(st.secrets.get("DB_POOL_RECYCLE", 1800)),
+    )
+
+
+##### Vector stores #####
+
+
+# Result of a similarity search, the chunk's embedding is only set when requested
+SearchResult = namedtuple(
+    "SearchResult", ["id", "text", "distance", "vector"], defaults=(None,)
+)
+
+
+# Formats a vector as a pgvector text literal, for the query parameters
+def format_vector(vector) -> str:
+    """
+    Formats a vector in the pgvector text representation "[x1,x2,...]".
+
+    psycopg2 sends query parameters as text, nine significant digits are enough to read back
+    the exact float32 values.
+
+    Args:
+    vector (numpy.ndarray or list): The vector, or its text representation.
+
+    Returns:
+    str: The text representation of the vector.
+    """
+    if isinstance(vector, str):
+        return vector
+    values = np.asarray(vector, dtype=np.float32).tolist()
+    return "[" + ",".join(["%.9g"] * len(values)) % tuple(values) + "]"
+
+
+# Reads a vector in the pgvector binary representation, as returned by vector_send()
+def vector_from_binary(data) -> np.ndarray:
+    """
+    Decodes a vector from the pgvector binary representation: the number of dimensions and an
+    unused field as big-endian int16, then the big-endian float32 values.
+
+    Args:
+    data (bytes or memoryview): The binary representation of the vector.
+
+    Returns:
+    numpy.ndarray: The float32 vector.
+    """
+    return np.frombuffer(data, dtype=">f4", offset=4).astype(np.float32)
+
+# Words too common to tell chunks apart in a lexical search
+STOPWORDS = frozenset(
+    "a about above after again all am an and any are as at be because been before being below "
+    "between both but by can could did do does doing down during each few for from further had "
+    "has have having he her here hers him his how i if in into is it its itself just me more most "
+    "my no nor not now of off on once only or other our ours out over own same she should so some "
+    "such than that the their theirs them then there these they this those through to too under "
+    "until up very was we were what when where which while who whom why will with would you your".split()
+)
+
+
+# Splits a text into the lowercase terms of the lexical search, keeping identifiers like "AB-12.3" whole
+def lexical_terms(text: str) -> list:
+    """
+    Extracts the searchable terms of a text.
+
+    Args:
+        text (str): The text of a chunk or a question.
+
+    Returns:
+        list: The terms of the text, in order, without stopwords.
+    """
+    return [
+        term
+        for term in re.findall(r"[a-z0-9]+(?:[-./][a-z0-9]+)*", text.lower())
+        if term not in STOPWORDS
+    ]
+
+
+class PgVectorStore:
+    """
+    Stores the chunks and embeddings of the documents in PostgreSQL with the pgvector extension.
+
+    The approximate search reads its candidates from an HNSW index over a quantized copy of the
+    embeddings, half-precision floats or binary signs (1 bit per dimension, 32 times smaller than
+    the full vectors), then reranks them on the full-precision embeddings.
+    """
+
+    # Expression ordering the rows by approximate distance to the query, it matches an index expression
+    CANDIDATE_ORDER = {
+        "halfvec": "embedding::halfvec(3072) <=> CAST(:query_vector AS VECTOR)::halfvec(3072)",
+        "binary": "binary_quantize(embedding)::bit(3072) <~> binary_quantize(CAST(:query_vector AS VECTOR))",
+    }
+
+    def __init__(self, engine, quantization: str = "halfvec"):
+        """
+        Initializes the store and makes sure its tables exist.
+
+        Args:
+            engine (sqlalchemy.engine.Engine): The engine connected to the PostgreSQL database.
+            quantization (str): The representation searched for candidates, "halfvec" or "binary".
+        """
+        if quantization not in self.CANDIDATE_ORDER:
+            raise ValueError(f"Unsupported quantization for pgvector: {quantization}")
+        self.quantization = quantization
+        self.engine = engine
+        # When this process last refreshed the last access time of each document
+        self.touched_at = {}
+        # Create a session maker bound to this engine
+        self.Session = sessionmaker(bind=self.engine)
+        self.ensure_table_exists()
+
+    def is_document_ingested(self, document_hash: str) -> bool:
+        """
+        Checks the document registry for an already ingested copy of the PDF.
+
+        The check only reads the registry, touch_document marks the document as recently used.
+
+        Args:
+            document_hash (str): The content hash of the uploaded PDF.
+
+        Returns:
+            bool: True if the document's embeddings are already in the vector store.
+        """
+        with self.engine.connect() as conn:
+            result = conn.execute(
+                text("SELECT 1 FROM pdf_documents WHERE document_hash = :document_hash;"),
+                {"document_hash": document_hash},
+            ).fetchone()
+            return result is not None
+
+    def touch_document(self, document_hash: str, interval_seconds: int = 60):
+        """
+        Marks a document as recently used, at most once per `interval_seconds`.
+
+        The registry row is updated in its own short transaction, so concurrent searches of the
+        same document never wait on its row lock for longer than this statement.
+
+        Args:
+            document_hash (str): The content hash of the PDF.
+            interval_seconds (int): The minimum number of seconds between two updates.
+        """
+        now = time.monotonic()
+        if now - self.touched_at.get(document_hash, -interval_seconds) < interval_seconds:
+            return
+        self.touched_at[document_hash] = now
+        with self.engine.connect() as conn:
+            # Other processes may have refreshed it already, the row is then left alone
+            conn.execute(
+                text("""
+                UPDATE pdf_documents SET last_accessed_at = NOW()
+                WHERE document_hash = :document_hash
+                AND last_accessed_at < NOW() - make_interval(secs => :interval_seconds);
+            """),
+                {"document_hash": document_hash, "interval_seconds": interval_seconds},
+            )
+            conn.commit()
+
+    def evict_documents(
+        self, max_documents: int = 100, ttl_hours: int = 24, cache_ttl_days: int = 30
+    ):
+        """
+        Removes the least recently used documents from the vector store.
+
+        A document is evicted when it has not been accessed for `ttl_hours`, or when it falls
+        outside the `max_documents` most recently used ones. Cached chunk embeddings unused for
+        `cache_ttl_days` are removed too.
+
+        Args:
+            max_documents (int): The maximum number of documents kept in the vector store.
+            ttl_hours (int): The number of hours after which an unused document expires.
+            cache_ttl_days (int): The number of days after which an unused cached embedding expires.
+        """
+        with self.engine.connect() as conn:
+            conn.execute(
+                text("""
+                WITH evicted AS (
+                    DELETE FROM pdf_documents
+                    WHERE last_accessed_at < NOW() - make_interval(hours => :ttl_hours)
+                    OR document_hash NOT IN (
+                        SELECT document_hash FROM pdf_documents
+                        ORDER BY last_accessed_at DESC
+                        LIMIT :max_documents
+                    )
+                    RETURNING document_hash
+                )
+                DELETE FROM pdf_holder
+                WHERE document_hash IN (SELECT document_hash FROM evicted)
+                OR document_hash IS NULL;
+            """),
+                {"max_documents": max_documents, "ttl_hours": ttl_hours},
+            )
+            conn.execute(
+                text("""
+                DELETE FROM embedding_cache
+                WHERE last_used_at < NOW() - make_interval(days => :cache_ttl_days);
+            """),
+                {"cache_ttl_days": cache_ttl_days},
+            )
+            conn.commit()
+
+    def get_cached_embeddings(self, model: str, chunk_hashes: list) -> dict:
+        """
+        Looks up which chunks have a cached embedding and marks them as recently used.
+
+        The vectors are not fetched, store_document copies them from the cache inside the database.
+
+        Args:
+            model (str): The embedding model.
+            chunk_hashes (list): The hashes of the chunks' texts.
+
+        Returns:
+            dict: The cached chunk hashes, each mapped to None in place of its embedding.
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text("""
+                UPDATE embedding_cache SET last_used_at = NOW()
+                WHERE model = :model AND chunk_hash = ANY(:chunk_hashes)
+                RETURNING chunk_hash;
+            """),
+                {"model": model, "chunk_hashes": list(chunk_hashes)},
+            ).fetchall()
+            conn.commit()
+        return {chunk_hash: None for (chunk_hash,) in rows}
+
+    def cache_embeddings(self, model: str, embeddings: list):
+        """
+        Adds the embeddings of new chunks to the cache.
+
+        Args:
+            model (str): The embedding model.
+            embeddings (list): Dictionaries with the "hash" of a chunk's text and its "vector".
+        """
+        if not embeddings:
+            return
+        with self.engine.connect() as conn:
+            # The vectors are copied in binary into a temporary table, then merged into the cache
+            conn.execute(
+                text("""
+                CREATE TEMPORARY TABLE embedding_cache_load (
+                    model TEXT, chunk_hash TEXT, embedding VECTOR(3072)
+                ) ON COMMIT DROP;
+            """)
+            )
+            conn.connection.cursor().copy_expert(
+                "COPY embedding_cache_load FROM STDIN WITH (FORMAT binary)",
+                self._rows_to_copy(
+                    (model, embedding["hash"], embedding["vector"]) for embedding in embeddings
+                ),
+            )
+            conn.execute(
+                text("""
+                INSERT INTO embedding_cache (model, chunk_hash, embedding)
+                SELECT model, chunk_hash, embedding FROM embedding_cache_load
+                ON CONFLICT (model, chunk_hash) DO UPDATE SET last_used_at = NOW();
+            """)
+            )
+            conn.commit()
+
+    def _rows_to_copy(self, rows) -> io.BytesIO:
+        """
+        Serializes rows into an in-memory buffer in the binary format of PostgreSQL's COPY.
+
+        Vectors are written in the pgvector binary representation, so the database neither formats
+        nor parses any number.
+
+        Args:
+            rows (iterable): Tuples of str (TEXT columns) and float32 vectors (VECTOR columns).
+
+        Returns:
+            io.BytesIO: The COPY data, rewound to the start.
+        """
+        buffer = io.BytesIO()
+        # Signature, flags and header extension length
+        buffer.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+        for row in rows:
+            buffer.write(struct.pack(">h", len(row)))
+            for value in row:
+                if isinstance(value, str):
+                    data = value.encode("utf8")
+                else:
+                    vector = np.asarray(value, dtype=">f4")
+                    data = struct.pack(">hh", len(vector), 0) + vector.tobytes()
+                buffer.write(struct.pack(">i", len(data)))
+                buffer.write(data)
+        buffer.write(struct.pack(">h", -1))
+        buffer.seek(0)
+        return buffer
+
+    def _insert_cached_rows(self, session, embeddings: list, document_hash: str) -> list:
+        """
+        Inserts the rows of the chunks whose embedding is in the embedding cache, without sending the vectors.
+
+        Returns:
+            list: The embeddings still to be sent, None if a cached one went missing.
+        """
+        cached = [embedding for embedding in embeddings if embedding.get("cached")]
+        if not cached:
+            return embeddings
+        inserted = session.execute(
+            text("""
+            INSERT INTO pdf_holder (document_hash, text, embedding)
+            SELECT :document_hash, chunks.text, cache.embedding
+            FROM unnest(CAST(:chunk_hashes AS TEXT[]), CAST(:texts AS TEXT[])) AS chunks (chunk_hash, text)
+            JOIN embedding_cache AS cache
+            ON cache.model = :model AND cache.chunk_hash = chunks.chunk_hash;
+        """),
+            {
+                "document_hash": document_hash,
+                "chunk_hashes": [embedding["hash"] for embedding in cached],
+                "texts": [embedding["text"] for embedding in cached],
+                "model": EMBEDDING_MODEL,
+            },
+        ).rowcount
+        if inserted == len(cached):
+            return [embedding for embedding in embeddings if not embedding.get("cached")]
+        # Cached embeddings were evicted in the meantime, their vectors were never fetched
+        return None
+
+    def store_document(
+        self, embeddings: list, document_hash: str, batch_size: int = 500
+    ) -> bool:
+        """
+        Stores the generated embeddings in the database and records the document in the registry.
+
+        Documents are stored side by side in pdf_holder, keyed by their content hash. The rows are
+        streamed with binary COPY in batches of `batch_size`, all within a single transaction. Rows whose
+        embedding came from the embedding cache are copied from it inside the database instead.
+
+        Args:
+            embeddings (list): A list of dictionaries containing text and their corresponding embeddings.
+            document_hash (str): The content hash of the uploaded PDF.
+            batch_size (int): The number of rows sent per COPY statement.
+
+        Returns:
+            bool: True if the operation succeeds, False otherwise.
+        """
+        session = self.Session()  # Create a new database session
+        try:
+            # Register the document first, so later uploads of the same bytes skip ingestion.
+            # If another session is ingesting the same PDF, this waits for it and inserts nothing.
+            registered = session.execute(
+                text("""
+                INSERT INTO pdf_documents (document_hash, chunk_count)
+                VALUES (:document_hash, :chunk_count)
+                ON CONFLICT (document_hash) DO NOTHING
+                RETURNING document_hash;
+            """),
+                {"document_hash": document_hash, "chunk_count": len(embeddings)},
+            ).fetchone()
+            if registered:
+                new_embeddings = self._insert_cached_rows(session, embeddings, document_hash)
+                if new_embeddings is None:
+                    # Nothing is stored, the next upload embeds the evicted chunks again
+                    session.rollback()
+                    return False
+                # COPY goes through the raw psycopg2 cursor of the session's connection
+                cursor = session.connection().connection.cursor()
+                for start in range(0, len(new_embeddings), batch_size):
+                    cursor.copy_expert(
+                        "COPY pdf_holder (document_hash, text, embedding) FROM STDIN WITH (FORMAT binary)",
+                        self._rows_to_copy(
+                            (document_hash, embedding["text"], embedding["vector"])
+                            for embedding in new_embeddings[start : start + batch_size]
+                        ),
+                    )
+            session.commit()  # Commit the changes
+            return True
+        finally:
+            session.close()  # Close the session
+
+    def search(
+        self,
+        query_vector,
+        document_hash: str,
+        k: int = 1,
+        use_index: bool = True,
+        ef_search: int = 100,
+        rerank_factor: int = None,
+        with_vectors: bool = False,
+    ) -> list:
+        """
+        Searches for the chunks of a document closest to a query vector, and marks the document as recently used.
+
+        With `use_index`, candidates are read from the HNSW index over the quantized embeddings,
+        then reranked by their exact cosine distance on the full-precision embeddings. Otherwise all
+        the chunks of the document are scanned.
+
+        Args:
+            query_vector (numpy.ndarray): The vectorized question.
+            document_hash (str): The content hash of the PDF to search in.
+            k (int): The number of closest chunks to return.
+            use_index (bool): Whether to search the approximate nearest neighbour index.
+            ef_search (int): The size of the HNSW candidate list, higher values trade latency for recall.
+            rerank_factor (int): The number of index candidates reranked per returned chunk, defaults
+                to 10 for half-precision candidates and 40 for the coarser binary ones.
+            with_vectors (bool): Whether to also return the embeddings of the chunks.
+
+        Returns:
+            list: The SearchResult of the closest chunks, ordered by exact distance.
+        """
+        if rerank_factor is None:
+            rerank_factor = 40 if self.quantization == "binary" else 10
+        params = {
+            "query_vector": format_vector(query_vector),
+            "document_hash": document_hash,
+            "k": k,
+        }
+        columns = "id, text, embedding <=> CAST(:query_vector AS VECTOR) AS distance"
+        if with_vectors:
+            columns += ", vector_send(embedding)"
+        if use_index:
+            params["candidates"] = k * rerank_factor
+            sql_query = text("""
+                WITH candidates AS (
+                    SELECT id, text, embedding
+                    FROM pdf_holder
+                    WHERE document_hash = :document_hash
+                    ORDER BY {order}
+                    LIMIT :candidates
+                )
+                SELECT {columns}
+                FROM candidates
+                ORDER BY distance
+                LIMIT :k;
+            """.format(columns=columns, order=self.CANDIDATE_ORDER[self.quantization]))
+        else:
+            sql_query = text("""
+                SELECT {columns}
+                FROM pdf_holder
+                WHERE document_hash = :document_hash
+                ORDER BY distance
+                LIMIT :k;
+            """.format(columns=columns))
+        self.touch_document(document_hash)
+        return self._run_search(sql_query, params, use_index, ef_search, with_vectors)
+
+    def hybrid_search(
+        self,
+        query_vector,
+        question: str,
+        document_hash: str,
+        k: int = 1,
+        prefilter: bool = False,
+        lexical_limit: int = 100,
+        rrf_k: int = 60,
+        ef_search: int = 100,
+        rerank_factor: int = None,
+        with_vectors: bool = False,
+    ) -> list:
+        """
+        Searches for the chunks of a document matching a question by keywords or by meaning.
+
+        The chunks containing the question's words, found through the full-text index, and the
+        chunks closest to the question's vector, found through the vector index, are merged by
+        reciprocal rank fusion: each chunk scores the sum of 1 / (rrf_k + rank) over both rankings.
+
+        With `prefilter`, only the chunks containing the question's words are scored, by their exact
+        vector distance, which avoids the vector index for questions quoting exact terms. When no
+        chunk contains them, it falls back to the vector search.
+
+        Args:
+            query_vector (numpy.ndarray): The vectorized question.
+            question (str): The text of the question.
+            document_hash (str): The content hash of the PDF to search in.
+            k (int): The number of chunks to return.
+            prefilter (bool): Whether to only score the chunks containing the question's words.
+            lexical_limit (int): The maximum number of keyword matches considered.
+            rrf_k (int): The rank offset of the fusion, higher values flatten the rankings.
+            ef_search (int): The size of the HNSW candidate list.
+            rerank_factor (int): The number of vector index candidates per returned chunk.
+            with_vectors (bool): Whether to also return the embeddings of the chunks.
+
+        Returns:
+            list: The SearchResult of the chunks, most relevant first, with their exact vector distances.
+        """
+        if rerank_factor is None:
+            rerank_factor = 40 if self.quantization == "binary" else 10
+        # Formatted once, the fallback to the vector search reuses it
+        query_vector = format_vector(query_vector)
+        params = {
+            "query_vector": query_vector,
+            "question": question,
+            "document_hash": document_hash,
+            "k": k,
+            "lexical_limit": lexical_limit,
+            "candidates": k * rerank_factor,
+            "rrf_k": rrf_k,
+        }
+        columns = "p.id, p.text, p.embedding <=> CAST(:query_vector AS VECTOR) AS distance"
+        if with_vectors:
+            columns += ", vector_send(p.embedding)"
+        # The question's words are OR-ed, a chunk does not need to contain all of them
+        lexical = """
+            query AS (
+                SELECT replace(plainto_tsquery('english', :question)::text, '&', '|')::tsquery AS q
+            ), lexical_candidates AS (
+                SELECT id, ts_rank_cd(text_search, query.q) AS score
+                FROM pdf_holder, query
+                WHERE document_hash = :document_hash AND text_search @@ query.q
+                ORDER BY score DESC
+                LIMIT :lexical_limit
+            )"""
+        self.touch_document(document_hash)
+        if prefilter:
+            sql_query = text(f"""
+                WITH {lexical}
+                SELECT {columns}
+                FROM lexical_candidates JOIN pdf_holder p USING (id)
+                ORDER BY distance
+                LIMIT :k;
+            """)
+            results = self._run_search(sql_query, params, False, ef_search, with_vectors)
+            if results:
+                return results
+            return self.search(
+                query_vector,
+                document_hash,
+                k=k,
+                ef_search=ef_search,
+                rerank_factor=rerank_factor,
+                with_vectors=with_vectors,
+            )
+        sql_query = text(f"""
+            WITH {lexical}, lexical AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+                FROM lexical_candidates
+            ), semantic_candidates AS (
+                SELECT id, embedding
+                FROM pdf_holder
+                WHERE document_hash = :document_hash
+                ORDER BY {self.CANDIDATE_ORDER[self.quantization]}
+                LIMIT :candidates
+            ), semantic AS (
+                SELECT id, ROW_NUMBER() OVER (
+                    ORDER BY embedding <=> CAST(:query_vector AS VECTOR)
+                ) AS rank
+                FROM semantic_candidates
+            ), fused AS (
+                SELECT id, SUM(1.0 / (:rrf_k + rank)) AS score
+                FROM (SELECT * FROM lexical UNION ALL SELECT * FROM semantic) AS ranks
+                GROUP BY id
+            )
+            SELECT {columns}
+            FROM fused JOIN pdf_holder p USING (id)
+            ORDER BY fused.score DESC
+            LIMIT :k;
+        """)
+        return self._run_search(sql_query, params, True, ef_search, with_vectors)
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import ProgrammingError
-from pdfminer.high_level import extract_text as pdf_extract_text
-from streamlit_lottie import st_lottie_spinner
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from oauth2client.service_account import ServiceAccountCredentials
+    def _run_search(
+        self, sql_query, params: dict, use_index: bool, ef_search: int, with_vectors: bool
+    ) -> list:
+        """
+        Runs a search query returning (id, text, distance[, embedding]) rows.
 
+        Returns:
+            list: The SearchResult of the rows, in the query's order.
+        """
+        with self.engine.connect() as conn:
+            if use_index:
+                # Both settings only last for the current transaction. The iterative scan keeps
+                # reading the index until enough rows of the document pass the WHERE filter.
+                conn.execute(
+                    text("""
+                    SELECT set_config('hnsw.ef_search', :ef_search, true),
+                           set_config('hnsw.iterative_scan', 'relaxed_order', true);
+                """),
+                    {"ef_search": str(ef_search)},
+                )
+            rows = conn.execute(sql_query, params).fetchall()
+            conn.commit()
+        if not with_vectors:
+            return [SearchResult(*row) for row in rows]
+        # Embeddings are read in the pgvector binary format, nothing to parse
+        return [
+            SearchResult(id, text_, distance, vector_from_binary(vector))
+            for id, text_, distance, vector in rows
+        ]
 
-# Function to load Lottie animations using URL
-@st.cache_data
-def load_lottieurl(url):
+    def ensure_table_exists(self):
+        """
+        Creates the pgvector extension, the tables and their indexes, and upgrades older tables.
+        """
+        with self.engine.connect() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+            conn.execute(
+                text("""
+                CREATE TABLE IF NOT EXISTS pdf_holder (
+                    id SERIAL PRIMARY KEY,
+                    document_hash TEXT,
+                    text TEXT,
+                    embedding VECTOR(3072)
+                );
+            """)
+            )
+            conn.execute(
+                text("""
+                CREATE TABLE IF NOT EXISTS pdf_documents (
+                    document_hash TEXT PRIMARY KEY,
+                    chunk_count INTEGER,
+                    ingested_at TIMESTAMPTZ DEFAULT NOW(),
+                    last_accessed_at TIMESTAMPTZ DEFAULT NOW()
+                );
+            """)
+            )
+            # Embeddings of chunks already seen in any document, keyed by model and text hash
+            conn.execute(
+                text("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model TEXT,
+                    chunk_hash TEXT,
+                    embedding VECTOR(3072),
+                    last_used_at TIMESTAMPTZ DEFAULT NOW(),
+                    PRIMARY KEY (model, chunk_hash)
+                );
+            """)
+            )
+            # Upgrade tables created when pdf_holder held a single document
+            conn.execute(
+                text("ALTER TABLE pdf_holder ADD COLUMN IF NOT EXISTS document_hash TEXT;")
+            )
+            conn.execute(
+                text(
+                    "ALTER TABLE pdf_documents ADD COLUMN IF NOT EXISTS last_accessed_at TIMESTAMPTZ DEFAULT NOW();"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS pdf_holder_document_hash_idx ON pdf_holder (document_hash);"
+                )
+            )
+            # Keywords of the chunks for the lexical search, computed for the existing rows too
+            conn.execute(
+                text("""
+                ALTER TABLE pdf_holder ADD COLUMN IF NOT EXISTS text_search TSVECTOR
+                GENERATED ALWAYS AS (to_tsvector('english', coalesce(text, ''))) STORED;
+            """)
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS pdf_holder_text_search_idx ON pdf_holder USING gin (text_search);"
+                )
+            )
+            conn.commit()
+        self.create_index()
+
+    def create_index(self, concurrently: bool = False):
+        """
+        Creates the HNSW index of the configured quantization, over the rows already stored too.
+
+        Switching an existing table to another quantization only needs this index, the quantized
+        embeddings are computed from the full-precision ones. On large tables, run it beforehand
+        with `concurrently` so that writes are not blocked while the index is built.
+
+        Args:
+            concurrently (bool): Whether to build the index without locking the table against writes.
+        """
+        # HNSW cannot index VECTOR(3072), so the index is built over the quantized embeddings
+        index = {
+            "halfvec": "pdf_holder_embedding_hnsw_idx ON pdf_holder USING hnsw ((embedding::halfvec(3072)) halfvec_cosine_ops)",
+            "binary": "pdf_holder_embedding_bit_hnsw_idx ON pdf_holder USING hnsw ((binary_quantize(embedding)::bit(3072)) bit_hamming_ops)",
+        }[self.quantization]
+        concurrently = "CONCURRENTLY " if concurrently else ""
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"CREATE INDEX {concurrently}IF NOT EXISTS {index};"))
+
+
+class LocalVectorStore:
     """
-    Fetches and caches a Lottie animation from a provided URL.
+    Stores the chunks and embeddings of the documents on the local disk, without any external database.
+
+    Each document is a float32 matrix of unit-normalized embeddings saved as a .npy file, memory-mapped
+    on first use, next to a .json file holding the text of its chunks. The modification time of the
+    .npy file records when the document was last used.
+
+    With the binary quantization, a compact copy of the embeddings (their signs, 32 times smaller)
+    is also saved and scanned first, and only its closest candidates are read from the
+    full-precision matrix to be reranked.
+    """
+
+    # An int8 copy is not offered, NumPy has no BLAS product for integers and scanning it is
+    # slower than the float32 matrix product of the exact search
+    QUANTIZATIONS = (None, "binary")
+
+    def __init__(self, directory: str, quantization: str = None):
+        """
+        Initializes the store in a directory, creating it if needed.
+
+        Args:
+            directory (str): The directory holding the documents' files.
+            quantization (str): The compact representation scanned for candidates, None or "binary".
+        """
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization for the local store: {quantization}")
+        self.directory = directory
+        self.quantization = quantization
+        os.makedirs(self.directory, exist_ok=True)
+        # document hash -> (embeddings matrix, quantized matrix, chunk texts) of the documents already loaded
+        self.documents = {}
+        # document hash -> keyword index of the documents already searched by keywords
+        self.lexical_indexes = {}
+        self.lock = threading.Lock()
+
+    def _path(self, document_hash: str, extension: str) -> str:
+        """
+        Returns the path of one of the files of a document.
+        """
+        return os.path.join(self.directory, f"{document_hash}.{extension}")
+
+    def _quantize(self, matrix: np.ndarray) -> np.ndarray:
+        """
+        Quantizes unit-normalized embeddings, one row per embedding.
+        """
+        return np.packbits(matrix > 0, axis=-1)
+
+    def _save_quantized(self, document_hash: str, matrix: np.ndarray):
+        """
+        Saves the quantized copy of a document's embeddings, atomically.
+        """
+        path = self._path(document_hash, f"{self.quantization}.npy")
+        sample = self._quantize(matrix[:1])
+        quantized = np.lib.format.open_memmap(
+            path + ".tmp", mode="w+", dtype=sample.dtype, shape=(len(matrix), sample.shape[1])
+        )
+        # Quantize in blocks of rows, so a large memory-mapped matrix is never copied whole
+        for start in range(0, len(matrix), 4096):
+            quantized[start : start + 4096] = self._quantize(matrix[start : start + 4096])
+        quantized.flush()
+        del quantized
+        os.replace(path + ".tmp", path)
+
+    def _load(self, document_hash: str):
+        """
+        Returns the memory-mapped embeddings, their quantized copy and the texts of a document, loading them on first use.
+
+        The quantized copy of a document stored without it, or with another quantization, is
+        created on first use.
+        """
+        with self.lock:
+            if document_hash not in self.documents:
+                with open(self._path(document_hash, "json"), encoding="utf8") as f:
+                    texts = json.load(f)
+                matrix = np.load(self._path(document_hash, "npy"), mmap_mode="r")
+                quantized = None
+                if self.quantization:
+                    path = self._path(document_hash, f"{self.quantization}.npy")
+                    if not os.path.exists(path):
+                        self._save_quantized(document_hash, matrix)
+                    quantized = np.load(path, mmap_mode="r")
+                self.documents[document_hash] = (matrix, quantized, texts)
+            return self.documents[document_hash]
+
+    def migrate(self):
+        """
+        Creates the missing quantized copies of all the documents, instead of on their first search.
+        """
+        for entry in os.scandir(self.directory):
+            name = entry.name
+            if name.endswith(".npy") and name.count(".") == 1:
+                self._load(name[: -len(".npy")])
+
+    def is_document_ingested(self, document_hash: str) -> bool:
+        """
+        Checks for an already ingested copy of the PDF and marks it as recently used.
+
+        Args:
+            document_hash (str): The content hash of the uploaded PDF.
+
+        Returns:
+            bool: True if the document's embeddings are already in the vector store.
+        """
+        try:
+            os.utime(self._path(document_hash, "npy"))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def touch_document(self, document_hash: str, **kwargs):
+        """
+        Marks a document as recently used, the check of is_document_ingested already does it.
+        """
+        self.is_document_ingested(document_hash)
+
+    def evict_documents(
+        self, max_documents: int = 100, ttl_hours: int = 24, cache_ttl_days: int = 30
+    ):
+        """
+        Removes the least recently used documents from the vector store, and the cached chunk
+        embeddings unused for `cache_ttl_days`.
+
+        Args:
+            max_documents (int): The maximum number of documents kept in the vector store.
+            ttl_hours (int): The number of hours after which an unused document expires.
+            cache_ttl_days (int): The number of days after which an unused cached embedding expires.
+        """
+        with self._cache_connection() as conn:
+            conn.execute(
+                "DELETE FROM embedding_cache WHERE last_used_at < ?",
+                (time.time() - cache_ttl_days * 86400,),
+            )
+        paths = sorted(
+            (
+                entry.path
+                for entry in os.scandir(self.directory)
+                if entry.name.endswith(".npy") and entry.name.count(".") == 1
+            ),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        expiry = time.time() - ttl_hours * 3600
+        for rank, path in enumerate(paths):
+            if rank >= max_documents or os.path.getmtime(path) < expiry:
+                document_hash = os.path.basename(path)[: -len(".npy")]
+                with self.lock:
+                    self.documents.pop(document_hash, None)
+                    self.lexical_indexes.pop(document_hash, None)
+                # int8.npy files were written by earlier versions
+                for extension in ("npy", "json", "int8.npy", "binary.npy"):
+                    try:
+                        os.remove(self._path(document_hash, extension))
+                    except FileNotFoundError:
+                        pass
+
+    @contextmanager
+    def _cache_connection(self):
+        """
+        Opens the SQLite database of the embedding cache, creating it on first use, and commits on exit.
+        """
+        conn = sqlite3.connect(os.path.join(self.directory, "embedding_cache.sqlite3"))
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model TEXT,
+                    chunk_hash TEXT,
+                    embedding BLOB,
+                    last_used_at REAL,
+                    PRIMARY KEY (model, chunk_hash)
+                )
+            """)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_cached_embeddings(self, model: str, chunk_hashes: list) -> dict:
+        """
+        Looks up the cached embeddings of chunks and marks them as recently used.
+
+        Args:
+            model (str): The embedding model.
+            chunk_hashes (list): The hashes of the chunks' texts.
+
+        Returns:
+            dict: The embedding of each cached chunk hash.
+        """
+        chunk_hashes = list(chunk_hashes)
+        found = {}
+        with self._cache_connection() as conn:
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(chunk_hashes), 500):
+                batch = chunk_hashes[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                condition = f"model = ? AND chunk_hash IN ({placeholders})"
+                rows = conn.execute(
+                    f"SELECT chunk_hash, embedding FROM embedding_cache WHERE {condition}",
+                    [model, *batch],
+                ).fetchall()
+                conn.execute(
+                    f"UPDATE embedding_cache SET last_used_at = ? WHERE {condition}",
+                    [time.time(), model, *batch],
+                )
+                for chunk_hash, embedding in rows:
+                    found[chunk_hash] = np.frombuffer(embedding, dtype=np.float32)
+        return found
+
+    def cache_embeddings(self, model: str, embeddings: list):
+        """
+        Adds the embeddings of new chunks to the cache.
+
+        Args:
+            model (str): The embedding model.
+            embeddings (list): Dictionaries with the "hash" of a chunk's text and its "vector".
+        """
+        with self._cache_connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        model,
+                        embedding["hash"],
+                        np.asarray(embedding["vector"], dtype=np.float32).tobytes(),
+                        time.time(),
+                    )
+                    for embedding in embeddings
+                ],
+            )
+
+    def store_document(self, embeddings: list, document_hash: str) -> bool:
+        """
+        Saves the embeddings and texts of a document.
+
+        Args:
+            embeddings (list): A list of dictionaries containing text and their corresponding embeddings.
+            document_hash (str): The content hash of the uploaded PDF.
+
+        Returns:
+            bool: True if the operation succeeds, False otherwise.
+        """
+        if self.is_document_ingested(document_hash):
+            return True
+        vectors = [embedding["vector"] for embedding in embeddings]
+        matrix = np.stack(vectors).astype(np.float32, copy=False)
+        # Normalize once at write time, so cosine distances are a single matrix product at search time
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        texts = [embedding["text"] for embedding in embeddings]
+        # Write to temporary files first so readers never see a partially written document
+        if self.quantization:
+            self._save_quantized(document_hash, matrix)
+        with open(self._path(document_hash, "json.tmp"), "w", encoding="utf8") as f:
+            json.dump(texts, f)
+        with open(self._path(document_hash, "npy.tmp"), "wb") as f:
+            np.save(f, matrix)
+        os.replace(self._path(document_hash, "json.tmp"), self._path(document_hash, "json"))
+        os.replace(self._path(document_hash, "npy.tmp"), self._path(document_hash, "npy"))
+        return True
+
+    def _lexical_index(self, document_hash: str, texts: list) -> tuple:
+        """
+        Returns the inverted index of a document's chunks, building it on first use.
+
+        Returns:
+            tuple: The term -> (rows, term frequencies) postings and the number of terms of each chunk.
+        """
+        with self.lock:
+            if document_hash not in self.lexical_indexes:
+                postings = defaultdict(lambda: ([], []))
+                lengths = np.zeros(len(texts), dtype=np.float32)
+                for row, chunk in enumerate(texts):
+                    terms = lexical_terms(chunk)
+                    lengths[row] = len(terms)
+                    for term, frequency in Counter(terms).items():
+                        postings[term][0].append(row)
+                        postings[term][1].append(frequency)
+                postings = {
+                    term: (np.array(rows), np.array(frequencies, dtype=np.float32))
+                    for term, (rows, frequencies) in postings.items()
+                }
+                self.lexical_indexes[document_hash] = (postings, lengths)
+            return self.lexical_indexes[document_hash]
+
+    def _lexical_ranking(self, document_hash: str, texts: list, question: str, limit: int):
+        """
+        Ranks the chunks containing the question's terms by their BM25 score.
+
+        Returns:
+            numpy.ndarray: The rows of at most `limit` matching chunks, best first.
+        """
+        postings, lengths = self._lexical_index(document_hash, texts)
+        scores = np.zeros(len(texts), dtype=np.float32)
+        k1, b = 1.2, 0.75
+        average_length = max(float(lengths.mean()), 1.0)
+        for term in set(lexical_terms(question)):
+            if term not in postings:
+                continue
+            rows, frequencies = postings[term]
+            idf = np.log(1 + (len(texts) - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = k1 * (1 - b + b * lengths[rows] / average_length)
+            scores[rows] += idf * frequencies * (k1 + 1) / (frequencies + norm)
+        matches = np.flatnonzero(scores)
+        return matches[np.argsort(-scores[matches], kind="stable")][:limit]
+
+    def hybrid_search(
+        self,
+        query_vector,
+        question: str,
+        document_hash: str,
+        k: int = 1,
+        prefilter: bool = False,
+        lexical_limit: int = 100,
+        rrf_k: int = 60,
+        with_vectors: bool = False,
+        **kwargs,
+    ) -> list:
+        """
+        Searches for the chunks of a document matching a question by keywords or by meaning.
+
+        The chunks containing the question's terms, ranked by BM25, and the chunks closest to the
+        question's vector are merged by reciprocal rank fusion. With `prefilter`, only the chunks
+        containing the question's terms are scored by vector distance, falling back to the vector
+        search when there are none.
+
+        Args:
+            query_vector (numpy.ndarray): The vectorized question.
+            question (str): The text of the question.
+            document_hash (str): The content hash of the PDF to search in.
+            k (int): The number of chunks to return.
+            prefilter (bool): Whether to only score the chunks containing the question's terms.
+            lexical_limit (int): The depth of both rankings.
+            rrf_k (int): The rank offset of the fusion, higher values flatten the rankings.
+            with_vectors (bool): Whether to also return the (normalized) embeddings of the chunks.
+
+        Returns:
+            list: The SearchResult of the chunks, most relevant first, with their exact vector distances.
+        """
+        if not self.is_document_ingested(document_hash):
+            return []
+        matrix, _, texts = self._load(document_hash)
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        lexical_rows = self._lexical_ranking(document_hash, texts, question, lexical_limit)
+        if prefilter and len(lexical_rows):
+            # Only the matching rows of the full-precision matrix are read
+            rows = np.sort(lexical_rows)
+            distances = 1.0 - matrix[rows] @ query
+            rows = rows[np.argsort(distances)][:k]
+        elif prefilter:
+            return self.search(query_vector, document_hash, k=k, with_vectors=with_vectors, **kwargs)
+        else:
+            semantic = self.search(query_vector, document_hash, k=lexical_limit, **kwargs)
+            scores = defaultdict(float)
+            for rank, row in enumerate(lexical_rows, 1):
+                scores[int(row)] += 1.0 / (rrf_k + rank)
+            for rank, result in enumerate(semantic, 1):
+                scores[result.id - 1] += 1.0 / (rrf_k + rank)
+            rows = np.array(sorted(scores, key=scores.get, reverse=True)[:k], dtype=np.int64)
+        return [
+            SearchResult(
+                int(row) + 1,
+                texts[row],
+                float(1.0 - matrix[row] @ query),
+                np.array(matrix[row]) if with_vectors else None,
+            )
+            for row in rows
+        ]
+
+    def _candidates(self, quantized: np.ndarray, query: np.ndarray, count: int) -> np.ndarray:
+        """
+        Returns the indices of the rows of the quantized matrix closest to a normalized query.
+        """
+        # Hamming distance between the sign bits
+        scores = np.bitwise_count(quantized ^ self._quantize(query)).sum(axis=1, dtype=np.int32)
+        count = min(count, len(scores))
+        return np.argpartition(scores, count - 1)[:count]
+
+    def search(
+        self,
+        query_vector,
+        document_hash: str,
+        k: int = 1,
+        with_vectors: bool = False,
+        rerank_factor: int = None,
+        **kwargs,
+    ) -> list:
+        """
+        Searches for the chunks of a document closest to a query vector, and marks the document as recently used.
+
+        Args:
+            query_vector (numpy.ndarray): The vectorized question.
+            document_hash (str): The content hash of the PDF to search in.
+            k (int): The number of closest chunks to return.
+            with_vectors (bool): Whether to also return the (normalized) embeddings of the chunks.
+            rerank_factor (int): The number of quantized candidates reranked per returned chunk,
+                defaults to 40.
+
+        Returns:
+            list: The SearchResult of the closest chunks, ordered by distance.
+        """
+        if not self.is_document_ingested(document_hash):
+            return []
+        matrix, quantized, texts = self._load(document_hash)
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        if quantized is None:
+            rows = np.arange(len(matrix))
+            distances = 1.0 - matrix @ query
+        else:
+            if rerank_factor is None:
+                rerank_factor = 40
+            # Only the candidates' rows of the full-precision matrix are read from disk
+            rows = np.sort(self._candidates(quantized, query, k * rerank_factor))
+            distances = 1.0 - matrix[rows] @ query
+        k = min(k, len(distances))
+        # Partial sort to find the k closest chunks, then order only those
+        closest = np.argpartition(distances, k - 1)[:k]
+        closest = closest[np.argsort(distances[closest])]
+        return [
+            SearchResult(
+                int(rows[index]) + 1,
+                texts[rows[index]],
+                float(distances[index]),
+                np.array(matrix[rows[index]]) if with_vectors else None,
+            )
+            for index in closest
+        ]
 
-    Args:
-    url (str): The URL of the Lottie animation.
+
+# Function to get the vector store shared by all the services
+@st.cache_resource
+def get_vector_store():
+    """
+    Creates and caches the vector store backend selected by the optional VECTOR_STORE secret.
+
+    "pgvector" (the default) uses the Supabase PostgreSQL database, "local" stores the documents
+    in the LOCAL_VECTOR_STORE_PATH directory (".vector_store" by default). The optional
+    VECTOR_QUANTIZATION secret selects the representation of the candidate search.
 
     Returns:
-    dict: The Lottie animation JSON or None if the request fails.
+        PgVectorStore or LocalVectorStore: The process-wide vector store.
+    """
+    quantization = st.secrets.get("VECTOR_QUANTIZATION")
+    if st.secrets.get("VECTOR_STORE", "pgvector") == "local":
+        return LocalVectorStore(
+            st.secrets.get("LOCAL_VECTOR_STORE_PATH", ".vector_store"), quantization
+        )
+    return PgVectorStore(get_engine(), quantization or "halfvec")
+
+
+class EmbeddingError(RuntimeError):
+    """
+    Raised when the chunks of a PDF could not be embedded, the API's error is its cause.
     """
-    r = requests.get(url)  # Perform the GET request
-    if r.status_code != 200:
-        return None  # Return None if request failed
-    return r.json()  # Return the JSON content of the Lottie animation
 
 
-# Load a specific Lottie animation to be used in the app
-loading_animation = load_lottieurl(
-    "https://lottie.host/5ac92c74-1a02-40ff-ac96-947c14236db1/u4nCMW6fXU.json"
+# Page numbers of headers and footers: "Page 3", "page 3 of 40", "3 / 40" or a bare "- 3 -"
+PAGE_NUMBER_PATTERN = re.compile(
+    r"\bpage\s+\d+(?:\s*(?:of|/)\s*\d+)?\b"
+    r"|(?:^|(?<=\s))\d+\s*(?:of|/)\s*\d+$"
+    r"|^[\s\-\u2013\u2014]*\d+[\s\-\u2013\u2014]*$"
 )
 
 
@@ -43,139 +1893,516 @@ class PreRunProcessor:
     Processes uploaded PDF files by extracting text and generating embeddings.
     """
 
-    def __init__(self):
+    def __init__(self, vector_store=None):
         """
-        Initializes the processor with an OpenAI API key and a connection to a PostgreSQL database.
+        Initializes the processor with an OpenAI API key and a vector store.
+
+        Args:
+        vector_store (PgVectorStore or LocalVectorStore): The vector store to use, defaults to the shared one.
         """
         # Load OpenAI API key from environment variables
         self.api_key = os.getenv("OPENAI_API_KEY")
-        # Establish connection to the PostgreSQL database from the Supabase platform
-        self.engine = create_engine(
-            st.secrets["SUPABASE_POSTGRES_URL"], echo=True, client_encoding="utf8"
-        )
-        # Create a session maker bound to this engine
-        self.Session = sessionmaker(bind=self.engine)
-        self.ensure_table_exists()
-
-    def pdf_to_text(self, uploaded_file, chunk_length: int = 1000) -> list:
+        # Use the vector store configured for the app, the Supabase database by default
+        self.vector_store = vector_store or get_vector_store()
+
+    def pdf_to_text(
+        self,
+        uploaded_file,
+        chunk_tokens: int = 300,
+        overlap_tokens: int = 50,
+        pages_per_task: int = 10,
+        max_processes: int = None,
+    ) -> list:
         """
         Extracts text from the uploaded PDF and splits it into manageable chunks.
 
+        The text is extracted page range by page range and chunked as it arrives, so the first
+        chunks are embedded while later pages are still being parsed. Duplicate chunks are
+        dropped before they are embedded.
+
         Args:
         uploaded_file (UploadedFile): The PDF file uploaded by the user.
-        chunk_length (int): The desired length of each text chunk.
+        chunk_tokens (int): The maximum number of tokens of each text chunk.
+        overlap_tokens (int): The maximum number of tokens a chunk repeats from the previous one.
+        pages_per_task (int): The number of pages extracted by a worker process at a time.
+        max_processes (int): The number of text extraction processes, defaults to the number of CPU cores.
 
         Returns:
-        list: A list of text chunks ready for embedding generation.
+        list: A list of dictionaries containing text chunks and their corresponding embeddings, empty if the PDF has no text.
+
+        Raises:
+        EmbeddingError: If the chunks could not be embedded.
         """
         # Extract text from the uploaded PDF
-        text = pdf_extract_text(uploaded_file)
-        # Split the text into chunks
-        chunks = [
-            text[i : i + chunk_length].replace("\n", "")
-            for i in range(0, len(text), chunk_length)
-        ]
-        return self._generate_embeddings(chunks)
+        page_texts = iter_pdf_text(
+            uploaded_file.getvalue(), pages_per_task, max_processes
+        )
+        chunks = self._chunk_text(page_texts, chunk_tokens, overlap_tokens)
+        return self._generate_embeddings(self._deduplicate_chunks(chunks))
 
-    def define_vector_store(self, embeddings: list) -> bool:
+    def define_vector_store(self, embeddings: list, document_hash: str, **kwargs) -> bool:
         """
-        Stores the generated embeddings in the database.
+        Stores the generated embeddings in the vector store.
 
         Args:
         embeddings (list): A list of dictionaries containing text and their corresponding embeddings.
+        document_hash (str): The content hash of the uploaded PDF.
+        **kwargs: Options of the vector store backend, such as the COPY batch_size of PgVectorStore.
 
         Returns:
         bool: True if the operation succeeds, False otherwise.
         """
-        session = self.Session()  # Create a new database session
-        try:
-            # Truncate the existing table and insert new embeddings
-            session.execute(text("TRUNCATE TABLE pdf_holder RESTART IDENTITY CASCADE;"))
-            for embedding in embeddings:
-                # Insert each embedding into the pdf_holder table
-                session.execute(
-                    text(
-                        "INSERT INTO pdf_holder (text, embedding) VALUES (:text, :embedding)"
-                    ),
-                    {"text": embedding["text"], "embedding": embedding["vector"]},
-                )
-            session.commit()  # Commit the changes
-            return True
-        except ProgrammingError as e:
-            if 'relation "pdf_holder" does not exist' in str(e.orig.pgerror):
-                # If the table doesn't exist, create it and the necessary extension
-                session.rollback()
-                session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
-                session.execute(
-                    text("""
-                    CREATE TABLE pdf_holder (
-                        id SERIAL PRIMARY KEY,
-                        text TEXT,
-                        embedding VECTOR(3072)
-                    );
-                """)
-                )
-                session.commit()
-                return False
+        return self.vector_store.store_document(embeddings, document_hash, **kwargs)
+
+    def _chunk_text(self, page_texts, chunk_tokens: int = 300, overlap_tokens: int = 50):
+        """
+        Splits a stream of page text into chunks of whole sentences bounded by a number of tokens.
+
+        Chunks end between sentences, at the end of a paragraph once they are half full, and start
+        with the last sentences of the previous chunk up to `overlap_tokens`. Sentences longer than
+        a chunk are split by tokens.
+
+        Args:
+        page_texts (iterable): The text of consecutive pages, each page ending with a form feed.
+        chunk_tokens (int): The maximum number of tokens of each text chunk.
+        overlap_tokens (int): The maximum number of tokens a chunk repeats from the previous one.
+
+        Yields:
+        str: The text chunks, in document order.
+        """
+        tokenizer = load_tokenizer()
+        # (text, token count) of the sentences of the current chunk, the first `overlap` come from the previous one
+        sentences, overlap = [], 0
+
+        def flush():
+            chunk = " ".join(sentence for sentence, _ in sentences)
+            # Keep the longest tail of sentences that fits in the overlap
+            tail, size = [], 0
+            for sentence, tokens in reversed(sentences):
+                if size + tokens > overlap_tokens:
+                    break
+                tail.insert(0, (sentence, tokens))
+                size += tokens
+            return chunk, tail
+
+        for paragraph in self._iter_paragraphs(page_texts):
+            for sentence in self._split_sentences(paragraph, tokenizer, chunk_tokens):
+                tokens = len(tokenizer.encode(sentence, disallowed_special=()))
+                if len(sentences) > overlap and (
+                    sum(size for _, size in sentences) + tokens > chunk_tokens
+                ):
+                    chunk, sentences = flush()
+                    overlap = len(sentences)
+                    yield chunk
+                # Drop overlapping sentences until the new sentence fits
+                while sentences and sum(size for _, size in sentences) + tokens > chunk_tokens:
+                    sentences.pop(0)
+                    overlap -= 1
+                sentences.append((sentence, tokens))
+            if len(sentences) > overlap and (
+                sum(size for _, size in sentences) >= chunk_tokens // 2
+            ):
+                chunk, sentences = flush()
+                overlap = len(sentences)
+                yield chunk
+        if len(sentences) > overlap:
+            yield flush()[0]
+
+    def _iter_paragraphs(self, page_texts, edge_lines: int = 3, max_line_length: int = 100):
+        """
+        Splits a stream of page text into paragraphs, without the headers and footers of the pages.
+
+        A short line among the first or last `edge_lines` lines of a page is a header or footer
+        when the same line, ignoring case and page numbers, is also at the edge of the previous or
+        the next page. Pages are therefore processed one page behind the extraction. Lines are joined
+        with spaces, words hyphenated at the end of a line are rejoined, and a paragraph running
+        over a page break is kept whole.
+
+        Args:
+        page_texts (iterable): The text of consecutive pages, each page ending with a form feed.
+        edge_lines (int): The number of lines at the top and bottom of a page checked for repeats.
+        max_line_length (int): The maximum length of a header or footer line.
+
+        Yields:
+        str: The paragraphs, in document order.
+        """
+        removed_lines = 0
+        pending = []
+
+        def iter_pages():
+            buffer = ""
+            for page_text in page_texts:
+                buffer += page_text
+                *pages, buffer = buffer.split("\f")
+                yield from pages
+            # The text after the last form feed is a last page without one
+            if buffer.strip():
+                yield buffer
+
+        def edge_keys(lines):
+            filled = [i for i, line in enumerate(lines) if line]
+            # Only the page numbers are ignored, other figures tell body lines apart
+            return {
+                i: PAGE_NUMBER_PATTERN.sub("#", lines[i].lower())
+                for i in filled[:edge_lines] + filled[-edge_lines:]
+                if len(lines[i]) <= max_line_length
+            }
+
+        def join(lines):
+            text = ""
+            for line in lines:
+                if text.endswith("-") and line[:1].islower():
+                    text = text[:-1] + line
+                else:
+                    text = f"{text} {line}" if text else line
+            return " ".join(text.split())
+
+        def page_paragraphs(lines, keys, neighbour_keys):
+            nonlocal removed_lines, pending
+            paragraphs, current = [], []
+            for i, line in enumerate(lines):
+                if keys.get(i) in neighbour_keys:
+                    removed_lines += 1
+                elif line:
+                    current.append(line)
+                elif current:
+                    paragraphs.append(current)
+                    current = []
+            if current:
+                paragraphs.append(current)
+            if not paragraphs:
+                return
+            # A paragraph left unfinished at the bottom of the previous page continues here
+            if pending and not re.search(r"[.!?:]$", pending[-1]):
+                paragraphs[0] = pending + paragraphs[0]
+            elif pending:
+                yield join(pending)
+            for paragraph in paragraphs[:-1]:
+                yield join(paragraph)
+            pending = paragraphs[-1]
+
+        previous_keys, page = set(), None
+        for page_text in iter_pages():
+            lines = [line.strip() for line in page_text.split("\n")]
+            keys = edge_keys(lines)
+            if page is not None:
+                yield from page_paragraphs(*page, previous_keys | set(keys.values()))
+                previous_keys = set(page[1].values())
+            page = (lines, keys)
+        if page is not None:
+            yield from page_paragraphs(*page, previous_keys)
+        if pending:
+            yield join(pending)
+        get_metrics().count("boilerplate_lines_removed", removed_lines)
+
+    def _split_sentences(self, paragraph: str, tokenizer, max_tokens: int):
+        """
+        Splits a paragraph into sentences, and sentences longer than `max_tokens` into token windows.
+
+        Args:
+        paragraph (str): The text of the paragraph.
+        tokenizer (tiktoken.Encoding): The tokenizer of the embedding model.
+        max_tokens (int): The maximum number of tokens of a sentence.
+
+        Returns:
+        list: The sentences of the paragraph.
+        """
+        sentences = []
+        for sentence in re.split(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])", paragraph):
+            tokens = tokenizer.encode(sentence, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                sentences.append(sentence)
             else:
-                raise
-        finally:
-            session.close()  # Close the session
+                sentences.extend(
+                    tokenizer.decode(tokens[i : i + max_tokens])
+                    for i in range(0, len(tokens), max_tokens)
+                )
+        return sentences
+
+    def _simhash(self, text: str) -> int:
+        """
+        Computes the 64-bit SimHash of the word trigrams of a text, similar texts differ by few bits.
+        """
+        words = text.split()
+        shingles = {" ".join(words[i : i + 3]) for i in range(max(len(words) - 2, 1))}
+        digests = b"".join(
+            hashlib.blake2b(shingle.encode("utf8"), digest_size=8).digest()
+            for shingle in shingles
+        )
+        hashes = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8)
+        # Each bit of the fingerprint is the majority vote of that bit over the shingles
+        bits = np.unpackbits(hashes, axis=1, bitorder="little")
+        majority = bits.sum(axis=0) * 2 > len(hashes)
+        return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+    def _deduplicate_chunks(self, chunks, max_hamming_distance: int = 3):
+        """
+        Drops the chunks that repeat an earlier chunk exactly or almost exactly.
+
+        Exact duplicates are found by the hash of their text with case and whitespace normalized,
+        near-duplicates by the Hamming distance between the SimHashes of their texts. The SimHashes
+        are indexed by four 16-bit bands, two fingerprints within 3 bits of each other share at
+        least one band. Near-duplicates must also contain the same numbers, chunks differing only
+        in their figures (table rows, specifications, prices) are all kept.
+
+        Args:
+        chunks (iterable): The text chunks, in document order.
+        max_hamming_distance (int): The number of differing SimHash bits of near-duplicates, at most 3.
+
+        Yields:
+        str: The chunks that are not duplicates, in document order.
+        """
+        digests, bands = set(), defaultdict(list)
+        dropped = 0
+        for chunk in chunks:
+            # Digits are kept, chunks differing only in figures (specs, prices, years) are distinct
+            normalized = " ".join(chunk.lower().split())
+            digest = hashlib.sha256(normalized.encode("utf8")).digest()
+            if digest in digests:
+                dropped += 1
+                continue
+            digests.add(digest)
+            fingerprint = self._simhash(normalized)
+            numbers = tuple(re.findall(r"\d+", normalized))
+            keys = [(band, (fingerprint >> (16 * band)) & 0xFFFF) for band in range(4)]
+            if any(
+                bin(fingerprint ^ other).count("1") <= max_hamming_distance
+                and other_numbers == numbers
+                for key in keys
+                for other, other_numbers in bands[key]
+            ):
+                dropped += 1
+                continue
+            for key in keys:
+                bands[key].append((fingerprint, numbers))
+            yield chunk
+        get_metrics().count("duplicate_chunks_dropped", dropped)
+
+    def _batch_chunks(
+        self, chunks, max_batch_tokens: int = 20000, max_batch_size: int = 2048
+    ):
+        """
+        Packs consecutive chunks into batches bounded by token count and number of inputs.
+
+        Batches are yielded as soon as they are full, so they can be embedded while the
+        following chunks are still being produced.
+
+        Args:
+        chunks (iterable): The (chunk index, chunk) pairs.
+        max_batch_tokens (int): The maximum number of tokens sent in a single embeddings request.
+        max_batch_size (int): The maximum number of inputs sent in a single embeddings request.
+
+        Yields:
+        list: A batch, as a list of (chunk index, chunk) pairs.
+        """
+        tokenizer = load_tokenizer()
+        batch, batch_tokens = [], 0
+        for index, chunk in chunks:
+            chunk_tokens = len(tokenizer.encode(chunk, disallowed_special=()))
+            # Close the current batch if adding this chunk would exceed either limit
+            if batch and (
+                batch_tokens + chunk_tokens > max_batch_tokens
+                or len(batch) >= max_batch_size
+            ):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append((index, chunk))
+            batch_tokens += chunk_tokens
+        if batch:
+            yield batch
+
+    def _embed_batch(self, batch_chunks: list) -> list:
+        """
+        Requests the embeddings of a single batch of chunks from the OpenAI API.
+
+        Args:
+        batch_chunks (list): The text chunks of the batch.
+
+        Returns:
+        numpy.ndarray: The float32 embeddings of the batch, one row per chunk in the same order.
+        """
+        with get_metrics().span("pre_run.embedding_batch"):
+            response = get_openai_gateway().call(
+                "embeddings",
+                tokens=estimate_tokens(batch_chunks),
+                model=EMBEDDING_MODEL,
+                input=batch_chunks,
+                encoding_format="base64",
+            )
+        if response.usage:
+            get_metrics().count("embedding_tokens", response.usage.total_tokens)
+        return embeddings_to_matrix(response)
+
+    def _generate_embeddings(
+        self,
+        chunks: list,
+        max_batch_tokens: int = 20000,
+        max_workers: int = 4,
+    ) -> list:
+        """
+        Generates embeddings for each text chunk using the OpenAI API.
+
+        The chunks are packed into token-bounded batches which are embedded concurrently. Each
+        request is rate limited and retried by the shared OpenAI gateway. Chunks already embedded
+        for any document are taken from the embedding cache, looked up batch by batch.
+
+        Args:
+        chunks (iterable): The text chunks, possibly still being extracted from the PDF.
+        max_batch_tokens (int): The maximum number of tokens sent in a single embeddings request.
+        max_workers (int): The maximum number of embeddings requests running at the same time.
+
+        Returns:
+        list: A list of dictionaries containing text chunks and their corresponding embeddings,
+        the embeddings are the float32 rows of a single matrix for the whole document.
 
-    def _generate_embeddings(self, chunks: list) -> list:
+        Raises:
+        EmbeddingError: If a batch could not be embedded, once the other batches are done or cancelled.
         """
-        Generates embeddings for each text chunk using the OpenAI API.
+        # Filter out null characters from each chunk, the first round submits batches as they fill up
+        cleaned_chunks = (chunk.replace("\x00", "") for chunk in chunks)
+        embeddings = {}
+        pending = self._batch_chunks(enumerate(cleaned_chunks), max_batch_tokens)
+
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._embed_uncached_batch, batch) for batch in pending]
+            for future in futures:
+                try:
+                    # Place each embedding at its chunk index to keep the document order
+                    embeddings.update(future.result())
+                except Exception as e:
+                    # Report the failure that opened the circuit rather than the fast failures after it
+                    if error is None or isinstance(error, CircuitOpenError):
+                        error = e
+                    if isinstance(e, CircuitOpenError):
+                        # The remaining batches would fail fast too
+                        for other in futures:
+                            other.cancel()
+
+        if error is not None:
+            raise EmbeddingError(f"{len(embeddings)} chunks embedded before {error!r}") from error
+        self.vector_store.cache_embeddings(
+            EMBEDDING_MODEL,
+            [embedding for embedding in embeddings.values() if not embedding.get("cached")],
+        )
+        ordered = [embeddings[index] for index in range(len(embeddings))]
+        # Cached embeddings left in the database have no vector here
+        fetched = [embedding for embedding in ordered if embedding["vector"] is not None]
+        if fetched:
+            # Gather the batches' rows into one contiguous matrix, the batches are then released
+            matrix = np.stack([embedding["vector"] for embedding in fetched])
+            for embedding, vector in zip(fetched, matrix):
+                embedding["vector"] = vector
+        return ordered
+
+    def _embed_uncached_batch(self, batch: list) -> dict:
+        """
+        Takes the embeddings of a batch's cached chunks from the embedding cache, and embeds the others.
 
         Args:
-        chunks (list): A list of text chunks.
+        batch (list): The (chunk index, chunk) pairs of the batch.
 
         Returns:
-        list: A list of dictionaries containing text chunks and their corresponding embeddings.
+        dict: The embedding of each chunk index of the batch, cached ones are flagged as such.
         """
-        try:
-            # Filter out null characters from each chunk
-            cleaned_chunks = [chunk.replace("\x00", "") for chunk in chunks]
-            response = openai.embeddings.create(
-                model="text-embedding-3-large", input=cleaned_chunks
-            )
-            return [
-                {
-                    "vector": embedding_info.embedding,
-                    "text": cleaned_chunks[embedding_info.index],
+        digests = [chunk_hash(chunk) for _, chunk in batch]
+        cached = self.vector_store.get_cached_embeddings(EMBEDDING_MODEL, set(digests))
+        get_metrics().count("embedding_cache_hits", sum(digest in cached for digest in digests))
+        embeddings, missing = {}, []
+        for (index, chunk), digest in zip(batch, digests):
+            if digest in cached:
+                embeddings[index] = {
+                    "vector": cached[digest],
+                    "text": chunk,
+                    "hash": digest,
+                    "cached": True,
                 }
-                for embedding_info in response.data
-            ]
-        except Exception as e:
-            st.error(f"An error occurred during embeddings generation: {e}")
-            return []
+            else:
+                missing.append((index, chunk, digest))
+        if missing:
+            vectors = self._embed_batch([chunk for _, chunk, _ in missing])
+            for (index, chunk, digest), vector in zip(missing, vectors):
+                embeddings[index] = {"vector": vector, "text": chunk, "hash": digest}
+        return embeddings
 
-    def ensure_table_exists(self):
-        with self.engine.connect() as conn:
-            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
-            conn.execute(
-                text("""
-                CREATE TABLE IF NOT EXISTS pdf_holder (
-                    id SERIAL PRIMARY KEY,
-                    text TEXT,
-                    embedding VECTOR(3072)
-                );
-            """)
-            )
-            conn.commit()
 
+# Computes the key of a chunk in the embedding cache from its text
+def chunk_hash(chunk: str) -> str:
+    """
+    Hashes the text of a chunk, so identical chunks of any document share their cached embedding.
+
+    Args:
+    chunk (str): The text of the chunk.
+
+    Returns:
+    str: The SHA-256 hex digest of the text.
+    """
+    return hashlib.sha256(chunk.encode("utf8")).hexdigest()
+
+
+# Computes a stable identifier for the uploaded PDF from its raw bytes
+def compute_document_hash(uploaded_file) -> str:
+    """
+    Hashes the content of the uploaded PDF so identical uploads map to the same document.
+
+    Args:
+    uploaded_file (UploadedFile): The PDF file uploaded by the user.
+
+    Returns:
+    str: The SHA-256 hex digest of the file content.
+    """
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
 
-# Function to process the uploaded PDF before any user interaction
+
+# Function to process the uploaded PDF before any user interaction, returns the document's hash once it is ingested
 def process_pre_run(uploaded_file):
+    # Streamlit reruns the script on every interaction, each upload is only hashed once per session
+    document_hashes = st.session_state.setdefault("document_hashes", {})
+    file_id = getattr(uploaded_file, "file_id", None)
+    document_hash = document_hashes.get(file_id)
+    if document_hash is None:
+        document_hash = compute_document_hash(uploaded_file)
+        if file_id is not None:
+            document_hashes[file_id] = document_hash
     processor_class = PreRunProcessor()
+    metrics = get_metrics()
     try:
-        embeddings = processor_class.pdf_to_text(uploaded_file)
+        # A repeat upload of the same PDF can reuse the embeddings already in the vector store.
+        # The registry is read on each rerun too since the document may have been evicted, it is
+        # then ingested again.
+        with metrics.span("pre_run.registry_lookup"):
+            ingested = processor_class.vector_store.is_document_ingested(document_hash)
+        if ingested:
+            # Throttled, reruns do not write to the registry
+            processor_class.vector_store.touch_document(document_hash)
+            if st.session_state.get("ingested_document_hash") != document_hash:
+                st.session_state["ingested_document_hash"] = document_hash
+                st.success("PDF successfully uploaded and processed.")
+            return document_hash
+        try:
+            with metrics.span("pre_run.pdf_to_text"):
+                embeddings = processor_class.pdf_to_text(
+                    uploaded_file,
+                    chunk_tokens=int(st.secrets.get("CHUNK_TOKENS", 300)),
+                    overlap_tokens=int(st.secrets.get("CHUNK_OVERLAP_TOKENS", 50)),
+                )
+        except EmbeddingError as e:
+            st.error(f"An error occurred during embeddings generation: {e.__cause__}")
+            return
         if not embeddings:
-            st.error("Failed to generate embeddings from the PDF.")
+            st.error("No text could be extracted from the PDF.")
             return
-        if not processor_class.define_vector_store(embeddings):
+        metrics.count("chunks_embedded", len(embeddings))
+        with metrics.span("pre_run.define_vector_store"):
+            stored = processor_class.define_vector_store(embeddings, document_hash)
+        if not stored:
             st.error("Failed to store the PDF embedding.")
         else:
+            st.session_state["ingested_document_hash"] = document_hash
+            # Keep the vector store bounded by dropping the least recently used documents
+            processor_class.vector_store.evict_documents()
             st.success("PDF successfully uploaded and processed.")
+            return document_hash
     except Exception as e:
         st.error(f"An error occurred during pre-processing: {e}")
 
@@ -189,16 +2416,17 @@ class IntentService:
     and checks the relatedness of questions to PDF content via database queries.
     """
 
-    def __init__(self):
+    def __init__(self, vector_store=None):
         """
-        Initializes the IntentService with the OpenAI API key and a connection to a PostgreSQL database.
+        Initializes the IntentService with the OpenAI API key and a vector store.
+
+        Args:
+            vector_store (PgVectorStore or LocalVectorStore): The vector store to use, defaults to the shared one.
         """
         # Retrieve OpenAI API key from environment variables
         self.api_key = os.getenv("OPENAI_API_KEY")
-        # Establish a connection to the PostgreSQL database hosted on the Supabase platform
-        self.engine = create_engine(
-            st.secrets["SUPABASE_POSTGRES_URL"], echo=True, client_encoding="utf8"
-        )
+        # Use the vector store configured for the app, the Supabase database by default
+        self.vector_store = vector_store or get_vector_store()
 
     def detect_malicious_intent(self, question):
         """
@@ -212,8 +2440,8 @@ class IntentService:
         """
         try:
             # Create a moderation request to OpenAI API with the provided question
-            response = openai.moderations.create(
-                model="text-moderation-latest", input=question
+            response = get_openai_gateway().call(
+                "moderations", model="text-moderation-latest", input=question
             )
             # Determine if the question was flagged as malicious
             is_flagged = response.results[0].flagged
@@ -230,10 +2458,33 @@ class IntentService:
             # Return none and an error message in case of an exception
             return None, f"Error in moderation: {str(e).split('. ')[0]}."
 
+    def detect_malicious_intents(self, questions: list, batch_size: int = 32) -> list:
+        """
+        Uses OpenAI's moderation model to detect malicious intent in many questions, with one request per batch.
+
+        Args:
+            questions (list): The questions as strings.
+            batch_size (int): The number of questions sent per moderation request.
+
+        Returns:
+            list: A boolean indicating if each question was flagged, in the order of the questions.
+        """
+        flags = []
+        for start in range(0, len(questions), batch_size):
+            response = get_openai_gateway().call(
+                "moderations",
+                model="text-moderation-latest",
+                input=questions[start : start + batch_size],
+            )
+            flags.extend(result.flagged for result in response.results)
+        return flags
+
     def query_database(self, query):
         """
         Executes a SQL query on the connected PostgreSQL database and returns the first result.
 
+        Only available with the pgvector backend.
+
         Args:
             query (str): SQL query string to be executed.
 
@@ -241,7 +2492,7 @@ class IntentService:
             sqlalchemy.engine.row.RowProxy or None: The first result row of the query or None if no results.
         """
         # Connect to the database and execute the given query
-        with self.engine.connect() as connection:
+        with self.vector_store.engine.connect() as connection:
             result = connection.execute(text(query)).fetchone()
             # Return the result if available; otherwise, return None
             return result if result else None
@@ -254,70 +2505,138 @@ class IntentService:
             question (str): The user's question as a string.
 
         Returns:
-            list: The vectorized form of the question as a list or an empty list on failure.
+            numpy.ndarray: The float32 vectorized form of the question, or an empty list on failure.
         """
         try:
             # Generate embeddings for the question using OpenAI's API
-            response = openai.embeddings.create(
-                input=question, model="text-embedding-3-large"
+            response = get_openai_gateway().call(
+                "embeddings",
+                tokens=estimate_tokens(question),
+                input=question,
+                model=EMBEDDING_MODEL,
+                encoding_format="base64",
             )
-            embedded_query = response.data[0].embedding
+            if response.usage:
+                get_metrics().count("embedding_tokens", response.usage.total_tokens)
+            embedded_query = embeddings_to_matrix(response)[0]
             # Verify the dimensionality of the embedding
-            if len(embedded_query) != 3072:
+            if len(embedded_query) != EMBEDDING_DIMENSIONS:
                 raise ValueError(
                     "The dimensionality of the question embedding does not match the expected 3072 dimensions."
                 )
             else:
-                # Convert the embedding to a numpy array and return it as a list
-                return np.array(embedded_query, dtype=np.float64).tolist()
+                # Return the float32 embedding as is, without converting it to Python floats
+                return embedded_query
         except Exception as e:
             # Log and return an empty list in case of an error
             print(f"Error embedding the question: {e}")
             return []
 
-    def check_relatedness_to_pdf_content(self, question):
+    def questions_to_embeddings(self, questions: list, batch_size: int = 2048) -> list:
+        """
+        Converts many questions into vector embeddings, with one OpenAI request per batch of questions.
+
+        Args:
+            questions (list): The questions as strings.
+            batch_size (int): The number of questions sent per embeddings request.
+
+        Returns:
+            numpy.ndarray: The float32 vectorized form of each question, one row per question in their order.
+        """
+        matrices = [np.empty((0, EMBEDDING_DIMENSIONS), dtype=np.float32)]
+        for start in range(0, len(questions), batch_size):
+            batch = questions[start : start + batch_size]
+            response = get_openai_gateway().call(
+                "embeddings",
+                tokens=estimate_tokens(batch),
+                input=batch,
+                model=EMBEDDING_MODEL,
+                encoding_format="base64",
+            )
+            if response.usage:
+                get_metrics().count("embedding_tokens", response.usage.total_tokens)
+            matrices.append(embeddings_to_matrix(response))
+        return np.concatenate(matrices)
+
+    def check_relatedness_to_pdf_content(
+        self,
+        question,
+        document_hash,
+        k=1,
+        question_vectorized=None,
+        with_vectors=False,
+        hybrid=False,
+        prefilter=False,
+        ef_search=100,
+        rerank_factor=None,
+    ):
         """
         Determines if a user's question is related to PDF content stored in the database by querying for similar embeddings.
 
+        The question is embedded once and a single top-k query both decides the relatedness, from the
+        distance of the closest chunk, and returns the retrieval candidates.
+
         Args:
             question (str): The user's question as a string.
+            document_hash (str): The content hash of the PDF the question is about.
+            k (int): The number of closest chunks to retrieve.
+            question_vectorized (numpy.ndarray): The question's embedding, when it was already computed.
+            with_vectors (bool): Whether the retrieved chunks include their embeddings.
+            hybrid (bool): Whether to also retrieve the chunks containing the question's words.
+            prefilter (bool): Whether the hybrid search only scores the chunks containing the question's words.
+            ef_search (int): The size of the HNSW candidate list of the pgvector search.
+            rerank_factor (int): The number of quantized candidates reranked per chunk, defaults to the store's.
 
         Returns:
-            tuple: A boolean indicating relatedness and a message explaining the result.
+            tuple: A boolean indicating relatedness, a message explaining the result and the SearchResult list of the closest chunks, or None when not related.
         """
         # Convert the question to vector embeddings
-        question_vectorized = self.question_to_embeddings(question)
+        if question_vectorized is None:
+            question_vectorized = self.question_to_embeddings(question)
 
         try:
-            # Query the database for the closest embedding to the question's embedding
-            with self.engine.connect() as conn:
-                result = conn.execute(
-                    text("""
-                    SELECT id, text, embedding <=> CAST(:question_vector AS VECTOR) AS distance 
-                    FROM pdf_holder
-                    ORDER BY distance ASC
-                    LIMIT 1;
-                """),
-                    {"question_vector": question_vectorized},
-                ).fetchone()
-
-                if result:
-                    # Determine if the closest embedding is below a certain threshold
-                    _, _, distance = result
-                    threshold = 0.65  # Define a threshold for relatedness
-                    if distance < threshold:
-                        # Return true and a message if the question is related to the PDF content
-                        return True, "Question is related to the PDF content..."
-                    else:
-                        # Return false and a message if the question is not sufficiently related
-                        return False, "Question is not related to the PDF content..."
+            # Query the vector store for the closest embeddings of the document to the question's embedding
+            if hybrid:
+                results = self.vector_store.hybrid_search(
+                    question_vectorized,
+                    question,
+                    document_hash,
+                    k=k,
+                    prefilter=prefilter,
+                    with_vectors=with_vectors,
+                    ef_search=ef_search,
+                    rerank_factor=rerank_factor,
+                )
+            else:
+                results = self.vector_store.search(
+                    question_vectorized,
+                    document_hash,
+                    k=k,
+                    with_vectors=with_vectors,
+                    ef_search=ef_search,
+                    rerank_factor=rerank_factor,
+                )
+
+            if results:
+                # Determine if the closest embedding is below a certain threshold
+                threshold = 0.65  # Define a threshold for relatedness
+                if min(result.distance for result in results) < threshold:
+                    # Return true, a message and the retrieved chunks if the question is related to the PDF content
+                    return (
+                        True,
+                        "Question is related to the PDF content...",
+                        results,
+                    )
                 else:
-                    # Return false and a message if no embedding was found in the database
-                    return False, "No match found in the database."
+                    # Return false and a message if the question is not sufficiently related
+                    return False, "Question is not related to the PDF content...", None
+            else:
+                # Return false and a message if no embedding was found in the database
+                return False, "No match found in the database.", None
         except Exception as e:
             # Log and return false in case of an error during the database query
             print(f"Error searching the database: {e}")
-            return False, f"Error searching the database: {e}"
+            return False, f"Error searching the database: {e}", None
 
 
 ##### Information retrieval service #####
@@ -328,48 +2647,164 @@ class InformationRetrievalService:
     Provides services for searching vectorized questions within a vector store in the database.
     """
 
-    def __init__(self):
+    def __init__(self, vector_store=None):
         """
-        Initializes the InformationRetrievalService with OpenAI API key and database connection.
+        Initializes the InformationRetrievalService with OpenAI API key and a vector store.
+
+        Args:
+            vector_store (PgVectorStore or LocalVectorStore): The vector store to use, defaults to the shared one.
         """
         # Retrieve OpenAI API key from environment variables
         self.api_key = os.getenv("OPENAI_API_KEY")
-        # Establish connection to the PostgreSQL database on the Supabase platform
-        self.engine = create_engine(
-            st.secrets["SUPABASE_POSTGRES_URL"], echo=True, client_encoding="utf8"
-        )
-        # Create a session maker bound to this engine
-        self.Session = sessionmaker(bind=self.engine)
+        # Use the vector store configured for the app, the Supabase database by default
+        self.vector_store = vector_store or get_vector_store()
+
+    def search_in_vector_store(
+        self,
+        vectorized_question: np.ndarray,
+        document_hash: str,
+        k: int = 8,
+        question: str = None,
+        prefilter: bool = False,
+        ef_search: int = 100,
+        rerank_factor: int = None,
+    ) -> list:
+        """
+        Searches for the closest matching chunks in the vector store to a given vectorized question.
+
+        Args:
+            vectorized_question (numpy.ndarray): The question converted into a vector.
+            document_hash (str): The content hash of the PDF to search in.
+            k (int): The number of top results to retrieve, defaults to 8.
+            question (str): The text of the question, when given the chunks containing its words are retrieved too.
+            prefilter (bool): Whether to only score the chunks containing the question's words.
+            ef_search (int): The size of the HNSW candidate list of the pgvector search.
+            rerank_factor (int): The number of quantized candidates reranked per chunk, defaults to the store's.
 
-    def search_in_vector_store(self, vectorized_question: str, k: int = 1) -> str:
+        Returns:
+            list: The SearchResult of the closest chunks with their distances and embeddings, or None if no match is found.
         """
-        Searches for the closest matching text in the vector store to a given vectorized question.
+        # Find the closest matches in the vector store with the provided vectorized question and k value
+        if question:
+            results = self.vector_store.hybrid_search(
+                vectorized_question,
+                question,
+                document_hash,
+                k=k,
+                prefilter=prefilter,
+                with_vectors=True,
+                ef_search=ef_search,
+                rerank_factor=rerank_factor,
+            )
+        else:
+            results = self.vector_store.search(
+                vectorized_question,
+                document_hash,
+                k=k,
+                with_vectors=True,
+                ef_search=ef_search,
+                rerank_factor=rerank_factor,
+            )
+        if results:
+            # Return the closest matches if results are found
+            return results
+        else:
+            # Display an error if no matching documents are found
+            st.error("No matching documents found.")
+
+    def select_diverse_chunks(
+        self,
+        results: list,
+        mmr_lambda: float = 0.7,
+        max_similarity: float = 0.95,
+    ) -> list:
+        """
+        Orders the retrieved chunks by maximal marginal relevance and drops near-duplicates.
+
+        Each step picks the chunk maximizing `mmr_lambda * relevance - (1 - mmr_lambda) * redundancy`,
+        where the redundancy is the highest cosine similarity to the chunks already picked. The
+        relevance comes from the rank of the chunk in the search's order, from 1 for the first chunk
+        down towards 0, so the fused ranking of the hybrid search is kept: a chunk ranked high for
+        the question's exact terms is not demoted for its weaker vector similarity.
 
         Args:
-            vectorized_question (str): The question converted into a vector.
-            k (int): The number of top results to retrieve, defaults to 1.
+            results (list): The SearchResult of the retrieved chunks, most relevant first, with their embeddings.
+            mmr_lambda (float): The weight of the relevance against the redundancy, 1 keeps the search's order.
+            max_similarity (float): The cosine similarity above which a chunk is a duplicate of a picked one.
 
         Returns:
-            str: The text of the closest matching document or an error message if no match is found.
+            list: The SearchResult of the kept chunks, in the order they were picked.
         """
-        # SQL query to find the closest match in the vector store
-        sql_query = text("""
-            SELECT id, text, embedding <=> CAST(:query_vector AS VECTOR) AS distance
-            FROM pdf_holder
-            ORDER BY distance
-            LIMIT :k
-        """)
-        # Execute the query with provided vectorized question and k value
-        with self.engine.connect() as conn:
-            results = conn.execute(
-                sql_query, {"query_vector": vectorized_question, "k": k}
-            ).fetchall()
-            if results:
-                # Return the text of the closest match if results are found
-                return results[0].text
-            else:
-                # Display an error if no matching documents are found
-                st.error("No matching documents found.")
+        if len(results) < 2 or any(result.vector is None for result in results):
+            return list(results)
+        vectors = np.array([result.vector for result in results], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        relevance = 1.0 - np.arange(len(results)) / len(results)
+        similarities = vectors @ vectors.T
+
+        picked = [int(np.argmax(relevance))]
+        redundancy = similarities[picked[0]].copy()
+        available = np.ones(len(results), dtype=bool)
+        available[picked[0]] = False
+        # Near-duplicates of the first pick are never worth their tokens
+        available &= redundancy < max_similarity
+        while available.any():
+            scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            scores[~available] = -np.inf
+            pick = int(np.argmax(scores))
+            picked.append(pick)
+            available[pick] = False
+            redundancy = np.maximum(redundancy, similarities[pick])
+            available &= redundancy < max_similarity
+        return [results[index] for index in picked]
+
+    def pack_context(self, results: list, max_context_tokens: int = 2000) -> str:
+        """
+        Joins the texts of the chunks, in order, into a context bounded by a number of tokens.
+
+        Chunks that do not fit in the remaining budget are skipped. The first chunk is truncated
+        if it alone exceeds the budget.
+
+        Args:
+            results (list): The SearchResult of the chunks, most useful first.
+            max_context_tokens (int): The maximum number of tokens of the context.
+
+        Returns:
+            str: The texts of the packed chunks, separated by blank lines.
+        """
+        tokenizer = load_tokenizer()
+        texts, used_tokens = [], 0
+        for result in results:
+            tokens = len(tokenizer.encode(result.text, disallowed_special=()))
+            if used_tokens + tokens <= max_context_tokens:
+                texts.append(result.text)
+                used_tokens += tokens
+        if not texts and results:
+            tokens = tokenizer.encode(results[0].text, disallowed_special=())
+            texts.append(tokenizer.decode(tokens[:max_context_tokens]))
+            used_tokens = min(len(tokens), max_context_tokens)
+        get_metrics().count("context_tokens", used_tokens)
+        return "\n\n".join(texts)
+
+    def build_context(
+        self,
+        results: list,
+        max_context_tokens: int = 2000,
+        mmr_lambda: float = 0.7,
+    ) -> str:
+        """
+        Builds the prompt context of a question from its retrieved chunks.
+
+        Args:
+            results (list): The SearchResult of the retrieved chunks.
+            max_context_tokens (int): The maximum number of tokens of the context.
+            mmr_lambda (float): The weight of the relevance against the redundancy of the chunks.
+
+        Returns:
+            str: The context of the question.
+        """
+        chunks = self.select_diverse_chunks(results, mmr_lambda)
+        return self.pack_context(chunks, max_context_tokens)
 
 
 ##### Response service #####
@@ -384,6 +2819,72 @@ class ResponseService:
         """
         # Load OpenAI API key from environment variables
         self.api_key = os.getenv("OPENAI_API_KEY")
+        # Seconds between the request and the first streamed token of the last streamed response
+        self.time_to_first_token = None
+
+    def _build_messages(self, question, retrieved_info):
+        """
+        Builds the chat messages asking to answer the question from the retrieved information.
+
+        Args:
+            question (str): The user's question.
+            retrieved_info (str): Information retrieved that is related to the question.
+
+        Returns:
+            list: The messages of the chat completion request.
+        """
+        return [
+            {
+                "role": "user",
+                "content": "Based on the FACTS, give a concise and detailed answer to the QUESTION."
+                + f"QUESTION: {question}. FACTS: {retrieved_info}",
+            }
+        ]
+
+    def stream_response(self, question, retrieved_info):
+        """
+        Streams a response from OpenAI's ChatCompletion API, token by token as they are generated.
+
+        The time to the first token is recorded in `time_to_first_token`. The generator does not
+        depend on Streamlit, so it can be consumed by any caller.
+
+        Args:
+            question (str): The user's question.
+            retrieved_info (str): Information retrieved that is related to the question.
+
+        Yields:
+            str: The successive pieces of the generated response.
+        """
+        self.time_to_first_token = None
+        start = time.perf_counter()
+        messages = self._build_messages(question, retrieved_info)
+        stream = get_openai_gateway().call(
+            "chat",
+            tokens=estimate_tokens([message["content"] for message in messages]),
+            model="gpt-4-turbo",
+            messages=messages,
+            stream=True,
+            # The token usage comes in a last chunk without choices
+            stream_options={"include_usage": True},
+        )
+        for chunk in stream:
+            if chunk.usage:
+                self._count_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - start
+                    get_metrics().observe(
+                        "response.first_token", self.time_to_first_token
+                    )
+                yield chunk.choices[0].delta.content
+
+    def _count_usage(self, usage):
+        """
+        Adds the prompt and completion tokens of a chat completion to the metrics.
+        """
+        metrics = get_metrics()
+        metrics.count("completion_prompt_tokens", usage.prompt_tokens)
+        metrics.count("completion_tokens", usage.completion_tokens)
 
     def generate_response(self, question, retrieved_info):
         """
@@ -397,16 +2898,15 @@ class ResponseService:
             str: The generated response or an error message if no response is available.
         """
         # Generate a response using the ChatCompletion API with the question and retrieved information
-        response = openai.chat.completions.create(
+        messages = self._build_messages(question, retrieved_info)
+        response = get_openai_gateway().call(
+            "chat",
+            tokens=estimate_tokens([message["content"] for message in messages]),
             model="gpt-4-turbo",
-            messages=[
-                {
-                    "role": "user",
-                    "content": "Based on the FACTS, give a concise and detailed answer to the QUESTION."
-                    + f"QUESTION: {question}. FACTS: {retrieved_info}",
-                }
-            ],
+            messages=messages,
         )
+        if response.usage:
+            self._count_usage(response.usage)
 
         if response.choices and response.choices[0].message.content:
             # Return the generated response if available
@@ -416,151 +2916,474 @@ class ResponseService:
             st.error("No content available.")
 
 
+##### Answer cache #####
+
+
+class SemanticAnswerCache:
+    """
+    Caches the answers to the questions asked about each document, and serves them again for
+    the same question or for a question whose embedding is close enough to a cached one.
+    """
+
+    def __init__(self, max_distance: float = 0.05, max_entries: int = 512):
+        """
+        Initializes an empty cache.
+
+        Args:
+            max_distance (float): The largest cosine distance between two questions sharing an answer.
+            max_entries (int): The number of answers kept, the least recently used are evicted first.
+        """
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        # (document hash, normalized question) -> (unit question embedding, answer), in LRU order
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # The cache is shared by every Streamlit session of the process
+        self.lock = threading.Lock()
+
+    def _normalize(self, question: str) -> str:
+        """
+        Normalizes a question so trivially different spellings share the same exact-match key.
+        """
+        return " ".join(question.lower().split())
+
+    def lookup(self, document_hash: str, question: str, question_vector=None):
+        """
+        Looks up the answer to a question about a document.
+
+        Without an embedding, only the exact same (normalized) question matches, and a failed lookup is
+        not counted as a miss since the semantic lookup is expected to follow.
+
+        Args:
+            document_hash (str): The content hash of the PDF the question is about.
+            question (str): The user's question.
+            question_vector (numpy.ndarray): The question's embedding, to also match similar questions.
+
+        Returns:
+            str: The cached answer, or None if there is none.
+        """
+        key = (document_hash, self._normalize(question))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][1]
+            if question_vector is None:
+                return None
+
+            keys = [
+                cached_key for cached_key in self.entries if cached_key[0] == document_hash
+            ]
+            if keys:
+                # Cosine distances to all the cached questions of the document at once
+                query = np.asarray(question_vector, dtype=np.float32)
+                matrix = np.stack([self.entries[cached_key][0] for cached_key in keys])
+                distances = 1.0 - matrix @ (query / np.linalg.norm(query))
+                best = int(np.argmin(distances))
+                if distances[best] <= self.max_distance:
+                    self.entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self.entries[keys[best]][1]
+            self.misses += 1
+            return None
+
+    def store(self, document_hash: str, question: str, question_vector, answer: str):
+        """
+        Adds the answer to a question about a document, evicting the least recently used answer when full.
+
+        Args:
+            document_hash (str): The content hash of the PDF the question is about.
+            question (str): The user's question.
+            question_vector (numpy.ndarray): The question's embedding.
+            answer (str): The generated answer.
+        """
+        vector = np.asarray(question_vector, dtype=np.float32)
+        with self.lock:
+            self.entries[(document_hash, self._normalize(question))] = (
+                vector / np.linalg.norm(vector),
+                answer,
+            )
+            self.entries.move_to_end((document_hash, self._normalize(question)))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits, misses and cached answers.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+# Function to get the answer cache shared by all the sessions of the process
+@st.cache_resource
+def get_answer_cache():
+    """
+    Creates and caches a single SemanticAnswerCache for the whole process.
+
+    The matching distance and size can be tuned with the optional ANSWER_CACHE_MAX_DISTANCE
+    and ANSWER_CACHE_SIZE secrets.
+
+    Returns:
+        SemanticAnswerCache: The process-wide answer cache.
+    """
+    return SemanticAnswerCache(
+        max_distance=float(st.secrets.get("ANSWER_CACHE_MAX_DISTANCE", 0.05)),
+        max_entries=int(st.secrets.get("ANSWER_CACHE_SIZE", 512)),
+    )
+
+
+##### Google Drive #####
+
+
+class DriveUploader:
+    """
+    Uploads files to Google Drive on a background thread, at most once per distinct content.
+    """
+
+    def __init__(self, chunk_size: int = 5 * 1024 * 1024, max_retries: int = 3):
+        """
+        Initializes the DriveUploader, the Drive client is created by the first upload.
+
+        Args:
+            chunk_size (int): The size in bytes of each request of the resumable upload.
+            max_retries (int): The number of times a failed chunk request is retried.
+        """
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.drive = None
+        # A single worker, the Drive client's HTTP connection is not thread-safe
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="drive-upload")
+        # document hash -> Future of the shareable link
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def _client(self):
+        """
+        Returns the authenticated Google Drive client, creating it on first use.
+        """
+        if self.drive is None:
+            from pydrive.auth import GoogleAuth
+            from pydrive.drive import GoogleDrive
+            from oauth2client.service_account import ServiceAccountCredentials
+
+            # Define the scope for Google Drive API access to allow file uploading and sharing.
+            scope = [
+                "https://www.googleapis.com/auth/drive.file",
+                "https://www.googleapis.com/auth/drive",
+            ]
+            # Load Google Drive API credentials from Streamlit secrets
+            credentials_dict = {
+                key: value for key, value in st.secrets["google_credentials"].items()
+            }
+            gauth = GoogleAuth()
+            gauth.credentials = ServiceAccountCredentials.from_json_keyfile_dict(
+                credentials_dict, scope
+            )
+            gauth.Authorize()  # Build the Drive API service once
+            self.drive = GoogleDrive(gauth)
+        return self.drive
+
+    def submit(self, name: str, data: bytes, document_hash: str):
+        """
+        Schedules the upload of a file, unless the same content was already uploaded or is being uploaded.
+
+        Args:
+            name (str): The name of the file on Google Drive.
+            data (bytes): The content of the file.
+            document_hash (str): The content hash of the file.
+
+        Returns:
+            concurrent.futures.Future: The future shareable link of the file.
+        """
+        with self.lock:
+            upload = self.uploads.get(document_hash)
+            # A failed upload is tried again
+            if upload is None or (upload.done() and upload.exception() is not None):
+                upload = self.executor.submit(self._upload, name, data, document_hash)
+                self.uploads[document_hash] = upload
+            return upload
+
+    def _upload(self, name: str, data: bytes, document_hash: str) -> str:
+        """
+        Uploads a file in resumable chunks and makes it viewable by anyone with the link.
+
+        Files are tagged with their content hash, so a file uploaded before a restart of the app
+        is found instead of uploaded again.
+
+        Returns:
+            str: The shareable link of the file.
+        """
+        service = self._client().auth.service
+        existing = (
+            service.files()
+            .list(
+                q=f"properties has {{ key='document_hash' and value='{document_hash}' "
+                "and visibility='PRIVATE' } and trashed = false",
+                maxResults=1,
+            )
+            .execute()
+        )
+        if existing.get("items"):
+            file_id = existing["items"][0]["id"]
+        else:
+            from googleapiclient.http import MediaIoBaseUpload
+
+            # Upload the bytes already in memory, chunk by chunk, each chunk request is retried on failure
+            media = MediaIoBaseUpload(
+                io.BytesIO(data),
+                mimetype="application/pdf",
+                chunksize=self.chunk_size,
+                resumable=True,
+            )
+            request = service.files().insert(
+                body={
+                    "title": name,
+                    "properties": [
+                        {"key": "document_hash", "value": document_hash, "visibility": "PRIVATE"}
+                    ],
+                },
+                media_body=media,
+            )
+            response = None
+            while response is None:
+                _, response = request.next_chunk(num_retries=self.max_retries)
+            file_id = response["id"]
+            # Change the uploaded file's sharing settings to make it viewable by anyone with the link.
+            service.permissions().insert(
+                fileId=file_id, body={"type": "anyone", "value": "anyone", "role": "reader"}
+            ).execute(num_retries=self.max_retries)
+        # Format the shareable link for preview.
+        return f"https://drive.google.com/file/d/{file_id}/preview"
+
+
+# Function to get the Google Drive uploader shared by all the sessions
+@st.cache_resource
+def get_drive_uploader():
+    """
+    Creates and caches a single DriveUploader for the whole process.
+
+    Returns:
+        DriveUploader: The process-wide Google Drive uploader.
+    """
+    return DriveUploader()
+
+
 ###### Independant & dependant of the function's class ######
 
 
-# Securely uploads a file to Google Drive and ensures the temporary file is deleted after upload
-def upload_to_google_drive(uploaded_file):
+# Uploads a file to Google Drive in the background and displays its link once it is available
+def upload_to_google_drive(uploaded_file, document_hash):
     """
-    Uploads a file to Google Drive using service account credentials, makes it publicly viewable,
-    and returns a shareable link for the uploaded file.
+    Starts the upload of a file to Google Drive in the background, without blocking the app, and
+    displays its shareable link once the upload is complete.
+
+    A file whose content was already uploaded is not uploaded again.
 
     Args:
         uploaded_file: The file uploaded by the user through the Streamlit interface.
+        document_hash: The content hash of the file.
 
     Returns:
-        str: The shareable link of the uploaded file.
+        concurrent.futures.Future: The future shareable link of the uploaded file.
     """
-    # Define the scope for Google Drive API access to allow file uploading and sharing.
-    scope = [
-        "https://www.googleapis.com/auth/drive.file",
-        "https://www.googleapis.com/auth/drive",
-    ]
+    upload = get_drive_uploader().submit(
+        uploaded_file.name, uploaded_file.getvalue(), document_hash
+    )
+    if not upload.done():
+        st.caption("Uploading the PDF to Google Drive in the background...")
+    elif upload.exception() is None:
+        st.write("Shareable link:", upload.result())
+    else:
+        # The upload is tried again on the next run of the app
+        st.warning(f"Upload to Google Drive failed: {upload.exception()}")
+    return upload
 
-    # Load Google Drive API credentials from Streamlit secrets
-    credentials_info = st.secrets["google_credentials"]
 
-    # Convert credentials info to a dictionary suitable for the oauth2client library.
-    # This step formats the credentials in a way that GoogleAuth can use for authentication.
-    credentials_dict = {key: value for key, value in credentials_info.items()}
+# Thread pool shared by the questions of all the sessions
+@st.cache_resource
+def get_question_executor():
+    """
+    Creates and caches the thread pool that runs the independent API calls of each question.
 
-    # Authenticate using the service account credentials to access Google Drive.
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-        credentials_dict, scope
-    )
-    gauth = GoogleAuth()
-    gauth.credentials = credentials  # Set the authenticated credentials
-    drive = GoogleDrive(
-        gauth
-    )  # Create a GoogleDrive instance with authenticated GoogleAuth instance
-
-    # Use a temporary file to store the uploaded file's content.
-    # This approach avoids loading the entire file content into memory, which is efficient for large files.
-    with tempfile.NamedTemporaryFile(
-        delete=False, suffix="-" + uploaded_file.name
-    ) as temp_file:
-        temp_file.write(
-            uploaded_file.read()
-        )  # Write the uploaded file content to the temporary file
-        temp_file_path = (
-            temp_file.name
-        )  # Store the path of the temporary file for later use in uploading
+    The pool is shared by all the sessions, its size can be tuned with the optional
+    QUESTION_WORKERS secret.
 
-    try:
-        # Create a new file on Google Drive using the uploaded file's name.
-        file_drive = drive.CreateFile({"title": uploaded_file.name})
-        # Set the content of the Google Drive file to that of the temporary file.
-        file_drive.SetContentFile(temp_file_path)
-        file_drive.Upload()  # Upload the file to Google Drive
-
-        # Change the uploaded file's sharing settings to make it viewable by anyone with the link.
-        file_drive.InsertPermission(
-            {"type": "anyone", "value": "anyone", "role": "reader"}
-        )
+    Returns:
+        ThreadPoolExecutor: The process-wide question thread pool.
+    """
+    return ThreadPoolExecutor(
+        max_workers=int(st.secrets.get("QUESTION_WORKERS", 8)),
+        thread_name_prefix="question",
+    )
 
-        # Format the shareable link for preview.
-        shareable_link = f"https://drive.google.com/file/d/{file_drive['id']}/preview"
 
-        # Print the shareable link for testing purposes.
-        st.write("Shareable link:", shareable_link)
+# Reads the retrieval settings from the optional secrets
+def get_retrieval_settings():
+    """
+    Returns the number of chunks retrieved per question (RETRIEVAL_K, default 8), the token budget
+    of their context (CONTEXT_MAX_TOKENS, default 2000), the relevance weight of their
+    diversification (MMR_LAMBDA, default 0.7), whether the chunks containing the question's words
+    are retrieved too (HYBRID_SEARCH, default true) and whether only those are scored
+    (LEXICAL_PREFILTER, default false). The recall of the approximate search is traded for latency
+    with the size of the HNSW candidate list (HNSW_EF_SEARCH, default 100, pgvector only) and the
+    number of quantized candidates reranked per chunk (RERANK_FACTOR, defaults to the store's).
 
-    finally:
-        # Ensure the temporary file is deleted after the upload process is complete.
-        # This cleanup step prevents accumulation of temporary files on the server.
-        os.unlink(temp_file_path)
+    Returns:
+        dict: The k, max_context_tokens, mmr_lambda, hybrid, prefilter, ef_search and rerank_factor settings.
+    """
+    rerank_factor = st.secrets.get("RERANK_FACTOR")
+    return {
+        "k": int(st.secrets.get("RETRIEVAL_K", 8)),
+        "max_context_tokens": int(st.secrets.get("CONTEXT_MAX_TOKENS", 2000)),
+        "mmr_lambda": float(st.secrets.get("MMR_LAMBDA", 0.7)),
+        "hybrid": bool(st.secrets.get("HYBRID_SEARCH", True)),
+        "prefilter": bool(st.secrets.get("LEXICAL_PREFILTER", False)),
+        "ef_search": int(st.secrets.get("HNSW_EF_SEARCH", 100)),
+        "rerank_factor": int(rerank_factor) if rerank_factor else None,
+    }
 
 
 # Orchestrates the processing of user questions regarding PDF content
-def intent_orchestrator(service_class, user_question):
+def intent_orchestrator(service_class, user_question, document_hash):
     """
     Orchestrates the process of checking a user's question for malicious intent and relevance to PDF content.
 
+    The moderation and the embedding and relatedness lookup are independent, they run concurrently
+    and the retrieval result is discarded when the moderation flags the question. Right after the
+    embedding, the answer cache is searched for a similar question already answered, the vector
+    search and the context packing are then skipped.
+
     Args:
         service_class: The class instance providing the services for intent detection and content relevance.
         user_question: The question posed by the user.
+        document_hash: The content hash of the PDF the question is about.
 
     Returns:
-        A tuple containing the vectorized question and the original question if relevant, or (None, None) otherwise.
+        A tuple containing the retrieved information, the original question, its embedding and the cached answer of a similar question if any, or (None, None, None, None) if the question is not processed.
     """
-    # Detect malicious intent in the user's question
-    is_flagged, flag_message = service_class.detect_malicious_intent(user_question)
-    st.write(flag_message)  # Display the flag message
+    metrics = get_metrics()
+    settings = get_retrieval_settings()
+    answer_cache = get_answer_cache()
+
+    def moderate():
+        with metrics.span("intent.moderation"):
+            return service_class.detect_malicious_intent(user_question)
+
+    def embed_and_search():
+        with metrics.span("intent.embedding"):
+            question_vectorized = service_class.question_to_embeddings(user_question)
+        if len(question_vectorized):
+            # A similar enough question was already answered
+            cached_response = answer_cache.lookup(
+                document_hash, user_question, question_vectorized
+            )
+            if cached_response is not None:
+                return question_vectorized, cached_response, None
+        with metrics.span("intent.vector_search"):
+            return question_vectorized, None, service_class.check_relatedness_to_pdf_content(
+                user_question,
+                document_hash,
+                k=settings["k"],
+                question_vectorized=question_vectorized,
+                with_vectors=True,
+                hybrid=settings["hybrid"],
+                prefilter=settings["prefilter"],
+                ef_search=settings["ef_search"],
+                rerank_factor=settings["rerank_factor"],
+            )
 
-    if is_flagged:
-        # If the question is flagged, do not process further
-        st.error("Your question was not processed. Please try a different question.")
-        return (None, None)
+    # Start the moderation and the relatedness lookup together, the slower of the two sets the latency
+    executor = get_question_executor()
+    with metrics.span("intent.total"):
+        moderation = executor.submit(moderate)
+        retrieval = executor.submit(embed_and_search)
 
-    # Check if the question is related to the PDF content
-    related, relatedness_message = service_class.check_relatedness_to_pdf_content(
-        user_question
-    )
+        # Detect malicious intent in the user's question
+        is_flagged, flag_message = moderation.result()
+        st.write(flag_message)  # Display the flag message
+
+        if is_flagged:
+            # If the question is flagged, do not process further and discard the retrieval
+            retrieval.cancel()
+            st.error("Your question was not processed. Please try a different question.")
+            return (None, None, None, None)
+
+        question_vectorized, cached_response, relatedness = retrieval.result()
+    if cached_response is not None:
+        return (None, user_question, question_vectorized, cached_response)
+
+    # Check if the question is related to the PDF content, the same lookup retrieved the related chunks
+    related, relatedness_message, results = relatedness
     st.write(relatedness_message)  # Display the relatedness message
 
     if related:
+        # Pack the most relevant and least redundant chunks into the question's context
+        retrieval_service = InformationRetrievalService(service_class.vector_store)
+        retrieved_info = retrieval_service.build_context(
+            results,
+            max_context_tokens=settings["max_context_tokens"],
+            mmr_lambda=settings["mmr_lambda"],
+        )
         # If the question is related, proceed with processing
-        vectorized_question = service_class.question_to_embeddings(user_question)
         st.success(
             "Your question was processed successfully. Now fetching an answer..."
         )
-        return (vectorized_question, user_question)
+        return (retrieved_info, user_question, question_vectorized, None)
     else:
         # If not related, do not process further
         st.error("Your question was not processed. Please try a different question.")
-        return (None, None)
+        return (None, None, None, None)
 
 
 # Starts the question processing workflow
-def process_user_question(service_class, user_question):
+def process_user_question(service_class, user_question, document_hash):
     """
     Initiates the processing of a user's question through various services.
 
     Args:
         service_class: The class instance providing services for processing the user's question.
         user_question: The question posed by the user.
+        document_hash: The content hash of the PDF the question is about.
 
     Returns:
         The result of the intent orchestration process.
     """
     # Orchestrates the intent processing of the user's question
-    result = intent_orchestrator(service_class, user_question)
+    result = intent_orchestrator(service_class, user_question, document_hash)
     return result
 
 
 # Initiates the retrieval process for information related to the user's question
-def process_retrieval(vectorized_question: str) -> tuple:
+def process_retrieval(vectorized_question: np.ndarray, document_hash: str) -> tuple:
     """
     Retrieves information related to the vectorized question from the vector store.
 
     Args:
-        vectorized_question (str): The vectorized form of the user's question.
+        vectorized_question (numpy.ndarray): The vectorized form of the user's question.
+        document_hash (str): The content hash of the PDF to search in.
 
     Returns:
-        Retrieved information related to the user's question.
+        Retrieved information related to the user's question, packed into a bounded context.
     """
     service = InformationRetrievalService()
-    retrieved_info = service.search_in_vector_store(vectorized_question)
-    return retrieved_info
+    settings = get_retrieval_settings()
+    with get_metrics().span("retrieval.vector_search"):
+        results = service.search_in_vector_store(
+            vectorized_question,
+            document_hash,
+            k=settings["k"],
+            ef_search=settings["ef_search"],
+            rerank_factor=settings["rerank_factor"],
+        )
+    if not results:
+        return None
+    return service.build_context(
+        results,
+        max_context_tokens=settings["max_context_tokens"],
+        mmr_lambda=settings["mmr_lambda"],
+    )
 
 
 # Generates a response based on the user's question and the retrieved information
@@ -576,8 +3399,36 @@ def process_response(retrieved_info, question):
         A generated response to the user's question.
     """
     response_service_processor = ResponseService()
-    final_response = response_service_processor.generate_response(
-        question, retrieved_info
+    with get_metrics().span("response.completion"):
+        final_response = response_service_processor.generate_response(
+            question, retrieved_info
+        )
+    return final_response
+
+
+# Streams the response to the user's question into the app as it is generated
+def process_streamed_response(retrieved_info, question):
+    """
+    Generates a response to the user's question and renders it token by token.
+
+    Args:
+        retrieved_info: Information related to the user's question retrieved from the vector store.
+        question: The original question posed by the user.
+
+    Returns:
+        The full generated response to the user's question, or None if nothing was generated.
+    """
+    response_service_processor = ResponseService()
+    with get_metrics().span("response.completion"):
+        final_response = st.write_stream(
+            response_service_processor.stream_response(question, retrieved_info)
+        )
+    if response_service_processor.time_to_first_token is None:
+        # Display an error if no content is generated
+        st.error("No content available.")
+        return None
+    st.caption(
+        f"First token after {response_service_processor.time_to_first_token:.2f} s"
     )
     return final_response
 
@@ -586,8 +3437,8 @@ def main():
     """
     The main function to run the Streamlit app, including a PDF viewer.
     """
-    # Set OpenAI API key from secrets
-    openai.api_key = st.secrets["OPENAI_API_KEY"]
+    # Set OpenAI API key from secrets, the OpenAI client reads it when it is first used
+    os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
 
     # Display the app's title
     st.title("Talk to your PDF")
@@ -597,14 +3448,25 @@ def main():
 
     # Check if a file has been uploaded
     if uploaded_file is not None:
-        # Display an animation while processing the uploaded PDF
-        with st_lottie_spinner(
-            loading_animation, quality="high", height="100px", width="100px"
-        ):
-            process_pre_run(uploaded_file)  # Preprocess the uploaded file
+        # Display an animation while processing the uploaded PDF, or a plain spinner without it
+        loading_animation = load_lottieurl(LOADING_ANIMATION_URL, LOADING_ANIMATION_PATH)
+        if loading_animation is not None:
+            from streamlit_lottie import st_lottie_spinner
+
+            spinner = st_lottie_spinner(
+                loading_animation, quality="high", height="100px", width="100px"
+            )
+        else:
+            spinner = st.spinner("Processing the PDF...")
+        with spinner:
+            document_hash = process_pre_run(uploaded_file)  # Preprocess the uploaded file
+
+        if document_hash is None:
+            # Nothing to ask questions about if the PDF could not be ingested
+            return
 
-        # Securely upload the processed file to Google Drive
-        upload_to_google_drive(uploaded_file)
+        # Securely upload the processed file to Google Drive, the questions do not wait for it
+        upload_to_google_drive(uploaded_file, document_hash)
 
         # Instantiate the service class for intent processing
         service_class = IntentService()
@@ -618,24 +3480,31 @@ def main():
 
         # Process the question if the submit button is pressed
         if submit_button:
-            result = process_user_question(service_class, user_question)
-
-            if result[0] is not None:  # If the question is related to the PDF content
-                vectorized_question, question = result
-
-                with st_lottie_spinner(
-                    loading_animation, quality="high", height="100px", width="100px"
-                ):
-                    retrieved_info = process_retrieval(
-                        vectorized_question
-                    )  # Retrieve relevant information
+            answer_cache = get_answer_cache()
+            # The exact same question was already answered, no need to call any API
+            cached_response = answer_cache.lookup(document_hash, user_question)
+            if cached_response is not None:
+                st.write(cached_response)
+                return
+
+            retrieved_info, question, vectorized_question, cached_response = (
+                process_user_question(service_class, user_question, document_hash)
+            )
 
-                    final_response = process_response(
-                        retrieved_info, question
-                    )  # Generate and display response
-                    st.write(final_response)
+            if cached_response is not None:
+                # A similar enough question was already answered, found right after the embedding
+                st.write(cached_response)
+            elif retrieved_info is not None:  # If the question is related to the PDF content
+                # Generate and display the response as it is streamed
+                final_response = process_streamed_response(retrieved_info, question)
+                if final_response:
+                    answer_cache.store(
+                        document_hash, question, vectorized_question, final_response
+                    )
 
 
 # Entry point of the Streamlit app
 if __name__ == "__main__":
     main()
+    # Rendered after main so the panel includes the stages of this run, whichever way main returned
+    render_metrics_panel()
@@ -0,0 +1,42 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from streamlit_app import PreRunProcessor  # noqa: E402
+
+SPEC = (
+    "The hydraulic pump of unit {unit} delivers a nominal flow of {flow} litres per minute at a "
+    "rated pressure of {pressure} bar. Its service interval is {hours} operating hours and the "
+    "mounting bolts are tightened to {torque} Nm. The seals and filters are replaced at every "
+    "service, and the oil level is checked before the unit is started after maintenance."
+)
+
+
+def make_processor():
+    # The chunking steps do not use the vector store
+    return PreRunProcessor(vector_store=object())
+
+
+def test_chunks_differing_only_in_numbers_are_kept():
+    chunks = [
+        SPEC.format(unit="A", flow=120, pressure=250, hours=500, torque=25),
+        SPEC.format(unit="A", flow=120, pressure=250, hours=1000, torque=25),
+        SPEC.format(unit="A", flow=180, pressure=250, hours=500, torque=25),
+    ]
+    assert list(make_processor()._deduplicate_chunks(chunks)) == chunks
+
+
+def test_repeated_chunks_are_dropped():
+    chunk = SPEC.format(unit="A", flow=120, pressure=250, hours=500, torque=25)
+    chunks = [chunk, chunk.upper(), chunk.replace(" ", "  ")]
+    assert list(make_processor()._deduplicate_chunks(chunks)) == [chunk]
+
+
+def test_page_numbers_are_removed_and_body_lines_with_figures_kept():
+    pages = [
+        f"Operator manual\n\nModel P-{page}00 max pressure {page * 50} bar.\n\nPage {page} of 3\f"
+        for page in range(1, 4)
+    ]
+    paragraphs = list(make_processor()._iter_paragraphs(pages))
+    assert paragraphs == [
+        f"Model P-{page}00 max pressure {page * 50} bar." for page in range(1, 4)
+    ]
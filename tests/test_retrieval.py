@@ -0,0 +1,42 @@
+import os, sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import streamlit_app  # noqa: E402
+from streamlit_app import InformationRetrievalService, SearchResult  # noqa: E402
+
+
+class WordTokenizer:
+    # Stands for the embedding model's tokenizer, one token per word
+    def encode(self, text, **kwargs):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_lexical_hit_of_the_hybrid_search_survives_build_context(monkeypatch):
+    monkeypatch.setattr(streamlit_app, "load_tokenizer", lambda: WordTokenizer())
+    rng = np.random.default_rng(0)
+    topic = unit(rng.standard_normal(64))
+    chunk = " ".join(["word"] * 300)
+    # Chunks close to the question by meaning, and one matching its exact part number only
+    semantic = [
+        SearchResult(i, f"semantic {i} {chunk}", 0.1, unit(topic + 0.3 * unit(rng.standard_normal(64))))
+        for i in range(1, 8)
+    ]
+    lexical = SearchResult(8, f"part AB-12.3 {chunk}", 0.6, unit(rng.standard_normal(64)))
+    # In the fused order of the hybrid search, the exact match is second
+    results = [semantic[0], lexical, *semantic[1:]]
+
+    service = InformationRetrievalService(vector_store=object())
+    context = service.build_context(results, max_context_tokens=1000)
+
+    assert "part AB-12.3" in context
+    assert context.startswith("semantic 1")